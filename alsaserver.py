@@ -2,12 +2,25 @@
 
 from pymidi import server
 from pymidi import packets
+from pymidi.protocol import ControlProtocol
 import pymidi
 import logging
 import sys
+import os
+import json
+import ctypes
+import errno
+import socket
+import select
+import mmap
+import struct
+import threading
 import signal
 import time
+import collections
 import alsa_midi
+from alsa_midi.client import SequencerClientBase
+import midiprofile
 
 #
 # Short-term fix for dealing with some software stability issues.
@@ -17,118 +30,1124 @@ import alsa_midi
 #
 
 logger = None
+alsaClient = None
+recorder = None
 peerStatus = {}
+daemonOptions = {}
 
-defaultPitchWheel = 0x2000
+defaultPitchWheel = 0 # ALSA's pitch bend is signed (-8192 to 8191) - it adds 0x2000 on the way out
 noteTimeout = 5
+loopTimeout = 0.5
+receiveBatchSize = 64
+outputRetryTimeout = 0.005
+subscriberInterval = 0.25
+stuckPolicy = {'policy':'adaptive', 'timeout':noteTimeout, 'silentTimeout':30, 'maxHold':60, 'pedalTimeout':30, 'sessionTimeout':60}
+pedalControllers = (64, 66) # Sustain and sostenuto
+systemCommonLengths = {0xf1:1, 0xf2:2, 0xf3:1}
+commandNames = {0x80:'note_off', 0x90:'note_on', 0xa0:'aftertouch', 0xb0:'control_mode_change',
+                0xc0:'program_change', 0xd0:'channel_pressure', 0xe0:'pitch_bend_change'}
 
+#
+# Controllers that are switches or parts of a sequence (bank select, data
+# entry, sustain and friends, RPN/NRPN, channel mode) are never thinned -
+# every value matters.
+#
+unthinnedControllers = {0, 6, 32, 38, 64, 65, 66, 67, 68, 69, 96, 97, 98, 99, 100, 101} | set(range(120, 128))
+
+#
+# Keeps track of what each peer is holding down - notes, pitch wheels and
+# the sustain and sostenuto pedals - so that anything left on when it
+# shouldn't be can be let go. What counts as stuck depends on the group's
+# policy (the "stuckNotes" option):
+#  adaptive - held while the peer has been silent for silentTimeout seconds
+#             (it has probably gone), or still held timeout seconds after
+#             packets from the peer went missing (the NoteOff may have been
+#             one of them). Pads and long chords from a peer that is still
+#             there are left alone. maxHold (seconds, 0 for none) is a
+#             backstop for anything else - such as the very last NoteOff
+#             going missing, after which there is no gap in the packets to
+#             notice and clock sync keeps the peer heard.
+#  fixed    - held for more than timeout seconds, unless the channel's
+#             sustain or sostenuto pedal is down. Pedals themselves are let
+#             go of after pedalTimeout seconds in case the packet lifting
+#             them was lost.
+#  off      - never.
+# Peers are "heard" when they send anything at all, including the clock
+# sync that RTP MIDI sends while nobody is playing. Whatever the policy,
+# everything a peer is holding is let go of as soon as it disconnects, or
+# when its session times out after sessionTimeout seconds (0 for never)
+# without hearing from it. Peers are told apart by their SSRC as two
+# participants can easily have the same name.
+#
 class peerInfo():
     def __init__(self, peerId):
         self.logger = logging.getLogger()
         self.peerId = peerId
         self.sequenceNumber = None
+        self.lastPacket = time.time()
+        self.lastHeard = self.lastPacket
+        self.lossTime = None
 
-        self._status = {}
-        self._status['pitchWheelTime'] = None
-        self._status['noteOnTime'] = [None]*128
-
-        self.channelInfo = [self._status]*16
+        self.heldNotes = {}
+        self.pitchWheels = {}
+        self.pedals = {}
 
     def __str__(self):
         return f'peerId {self.peerId} sequenceNumber {self.sequenceNumber}'
 
+    def packet(self, sequenceNumber):
+        self.lastPacket = time.time()
+
+        if self.sequenceNumber is not None:
+            missing = (sequenceNumber-self.sequenceNumber-1)&0xffff
+            if missing >= 0x8000: return # Late or duplicate packet
+            if missing:
+                self.logger.warning(f'{self.peerId} lost {missing} packets')
+                self.lossTime = self.lastPacket
+
+        self.sequenceNumber = sequenceNumber
+
     def pitchWheel(self, channel):
-        self.channelInfo[channel]['pitchWheelTime'] = time.time()
+        self.pitchWheels[channel] = time.time()
 
     def noteOn(self, channel, note):
-        noteNumber = int(note)
-        self.channelInfo[channel]['noteOnTime'][noteNumber] = time.time()
+        self.heldNotes[(channel, int(note))] = time.time()
 
     def noteOff(self, channel, note):
-        noteNumber = int(note)
-        self.channelInfo[channel]['noteOnTime'][noteNumber] = None
+        self.heldNotes.pop((channel, int(note)), None)
+
+    def pedal(self, channel, controller, value):
+        if value >= 64:
+            self.pedals.setdefault((channel, controller), time.time())
+        else:
+            self.pedals.pop((channel, controller), None)
+
+    def silentFor(self, now):
+        return now-max(self.lastPacket, self.lastHeard)
+
+    def isStuck(self, heldSince, now, pedal=False):
+        policy = stuckPolicy['policy']
+
+        if policy == 'fixed': return now-heldSince > stuckPolicy['pedalTimeout' if pedal else 'timeout']
+        if policy != 'adaptive': return False
+
+        if self.silentFor(now) > stuckPolicy['silentTimeout']: return True
+        if self.lossTime and self.lossTime >= heldSince and now-self.lossTime > stuckPolicy['timeout']: return True
+        if stuckPolicy['maxHold'] and now-heldSince > stuckPolicy['maxHold']: return True
+
+        return False
 
     def checkForStuck(self, alsaClient):
         now = time.time()
+        sent = False
+
+        for channel, controller in list(self.pedals):
+            if self.isStuck(self.pedals[(channel, controller)], now, pedal=True):
+                self.logger.info(f'Pedal {controller} stuck on channel {channel} - resetting')
+                alsaClient.event_output(alsa_midi.ControlChangeEvent(param=controller, value=0, channel=channel))
+                del self.pedals[(channel, controller)]
+                sent = True
+
+        for channel in list(self.pitchWheels):
+            if self.isStuck(self.pitchWheels[channel], now):
+                self.logger.info(f'Pitch wheel stuck on channel {channel} - resetting')
+                alsaClient.event_output(alsa_midi.PitchBendEvent(value=defaultPitchWheel, channel=channel))
+                del self.pitchWheels[channel]
+                sent = True
+
+        pedalChannels = {channel for channel, controller in self.pedals}
+        for channel, noteNumber in list(self.heldNotes):
+            if stuckPolicy['policy'] == 'fixed' and channel in pedalChannels: continue
+
+            if self.isStuck(self.heldNotes[(channel, noteNumber)], now):
+                self.logger.info(f'Note {noteNumber} stuck on channel {channel} - resetting')
+                alsaClient.event_output(alsa_midi.NoteOffEvent(note=noteNumber, velocity=64, channel=channel))
+                del self.heldNotes[(channel, noteNumber)]
+                sent = True
+
+        if sent: alsaClient.drain_output()
+
+    #
+    # Sends NoteOff for everything this peer is holding, lets go of its
+    # pedals and centres any pitch wheels it has moved, all in one go. Used
+    # when the peer has gone and when we are being shut down so that nobody
+    # is left with notes playing.
+    #
+    def releaseAll(self, alsaClient):
+        for channel, noteNumber in self.heldNotes:
+            alsaClient.event_output(alsa_midi.NoteOffEvent(note=noteNumber, velocity=64, channel=channel))
+        for channel, controller in self.pedals:
+            alsaClient.event_output(alsa_midi.ControlChangeEvent(param=controller, value=0, channel=channel))
+        for channel in self.pitchWheels:
+            alsaClient.event_output(alsa_midi.PitchBendEvent(value=defaultPitchWheel, channel=channel))
+
+        self.heldNotes = {}
+        self.pedals = {}
+        self.pitchWheels = {}
+
+        alsaClient.drain_output()
+
+#
+# Decodes the MIDI command section of an RTP MIDI datagram (RFC 6295)
+# straight from the buffer it arrived in, without building any objects
+# along the way. Returns the sender's SSRC, the sequence number and a list
+# of (status, data1, data2) messages with running status filled in. Delta
+# times are skipped (everything is sent on as soon as it arrives anyway),
+# as are system exclusive and system common messages and the recovery
+# journal. Returns None if the datagram isn't RTP MIDI.
+#
+def parseMidiPacket(data):
+    view = memoryview(data)
+    size = len(view)
+    if size < 13 or view[0]&0xc0 != 0x80 or view[1]&0x7f != 0x61: return None
+
+    sequenceNumber = (view[2]<<8)|view[3]
+    ssrc = (view[8]<<24)|(view[9]<<16)|(view[10]<<8)|view[11]
+
+    position = 12+(view[0]&0x0f)*4 # Skip any CSRCs
+    if view[0]&0x10 and position+4 <= size: # and any header extension
+        position += 4+((view[position+2]<<8)|view[position+3])*4
+    if position >= size: return None
+
+    flags = view[position]
+    length = flags&0x0f
+    position += 1
+    if flags&0x80:
+        if position >= size: return None
+        length = (length<<8)|view[position]
+        position += 1
+    end = min(position+length, size)
+
+    messages = []
+    status = 0
+    delta = flags&0x20 # The first message only has a delta time if Z is set
+    while position < end:
+        if delta:
+            while position < end and view[position]&0x80: position += 1
+            position += 1
+            if position >= end: break
+        delta = True
+
+        byte = view[position]
+        if byte&0x80:
+            position += 1
+            if byte >= 0xf8: continue # Real time - running status carries on
+            if byte >= 0xf0:
+                status = 0
+                if byte in (0xf0, 0xf7): # System exclusive (or a segment of one)
+                    while position < end and view[position] not in (0xf0, 0xf7, 0xf4): position += 1
+                    position += 1
+                else:
+                    position += systemCommonLengths.get(byte, 0)
+                continue
+            status = byte
+        elif not status:
+            break # Data with no status - give up on the rest
+
+        # A data byte with the top bit set means the packet is broken -
+        # give up on the rest of it
+        if status&0xe0 == 0xc0: # Program change and channel pressure
+            if position+1 > end or view[position]&0x80: break
+            messages.append((status, view[position], 0))
+            position += 1
+        else:
+            if position+2 > end or (view[position]|view[position+1])&0x80: break
+            messages.append((status, view[position], view[position+1]))
+            position += 2
+
+    return ssrc, sequenceNumber, messages
+
+#
+# The same for a packet that pymidi has decoded - its commands are turned
+# back into MIDI messages.
+#
+def pymidiMessages(midi_packet):
+    messages = []
+
+    for command in midi_packet.command.midi_list:
+        params = command.params
+        if command.command == 'note_on':
+            messages.append((0x90|command.channel, params.key, params.velocity))
+        elif command.command == 'note_off':
+            messages.append((0x80|command.channel, params.key, params.velocity))
+        elif command.command == 'aftertouch':
+            messages.append((0xa0|command.channel, params.key, params.touch))
+        elif command.command == 'pitch_bend_change':
+            messages.append((0xe0|command.channel, params.lsb, params.msb))
+        elif command.command == 'control_mode_change':
+            messages.append((0xb0|command.channel, params.controller, params.value))
+        else:
+            logging.getLogger().warning(f'Unknown command: {command.command}')
+            logging.getLogger().warning(command)
+
+    return messages
+
+#
+# Reads every datagram waiting on a socket in one go - with a single
+# recvmmsg() call where the C library has it, otherwise by reading without
+# blocking until there is nothing left. Returns a list of (data, address)
+# where data is a memoryview into a buffer that is reused on the next call,
+# so it has to be dealt with (or copied) before then.
+#
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+class datagramReceiver():
+    addressSize = 28 # Big enough for IPv6
+
+    def __init__(self, batchSize=receiveBatchSize, bufferSize=1024):
+        self.logger = logging.getLogger()
+        self.batchSize = batchSize
+        self.bufferSize = bufferSize
+        self.buffers = bytearray(batchSize*bufferSize)
+        self.view = memoryview(self.buffers)
+        self.recvmmsg = None
+        self.received = batchSize
+        self.knownAddresses = {}
+
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.recvmmsg = libc.recvmmsg
+        except Exception as e:
+            self.logger.info(f'recvmmsg not available - reading datagrams one at a time: {e}')
+            return
+
+        self.addresses = bytearray(batchSize*self.addressSize)
+        bufferBase = ctypes.addressof((ctypes.c_char*len(self.buffers)).from_buffer(self.buffers))
+        addressBase = ctypes.addressof((ctypes.c_char*len(self.addresses)).from_buffer(self.addresses))
+
+        self.vectors = (iovec*batchSize)()
+        self.messages = (mmsghdr*batchSize)()
+        for index in range(batchSize):
+            self.vectors[index].iov_base = bufferBase+index*bufferSize
+            self.vectors[index].iov_len = bufferSize
+            header = self.messages[index].msg_hdr
+            header.msg_name = addressBase+index*self.addressSize
+            header.msg_iov = ctypes.pointer(self.vectors[index])
+            header.msg_iovlen = 1
+
+    def receive(self, readySocket):
+        if self.recvmmsg:
+            for index in range(self.received): self.messages[index].msg_hdr.msg_namelen = self.addressSize
+            count = self.recvmmsg(readySocket.fileno(), self.messages, self.batchSize, socket.MSG_DONTWAIT, None)
+            self.received = max(count, 0)
+            if count < 0:
+                error = ctypes.get_errno()
+                if error not in (errno.EAGAIN, errno.EWOULDBLOCK): self.logger.warning(f'recvmmsg failed: {os.strerror(error)}')
+                return []
+
+            return [(self.view[index*self.bufferSize:index*self.bufferSize+self.messages[index].msg_len],
+                     self.address(index)) for index in range(count)]
+
+        datagrams = []
+        for index in range(self.batchSize):
+            try:
+                size, addr = readySocket.recvfrom_into(self.view[index*self.bufferSize:(index+1)*self.bufferSize], 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                self.logger.warning(f'recvfrom failed: {e.strerror}')
+                break
+            datagrams.append((self.view[index*self.bufferSize:index*self.bufferSize+size], addr))
+
+        return datagrams
+
+    def address(self, index):
+        raw = bytes(self.addresses[index*self.addressSize:(index+1)*self.addressSize])
+        if raw in self.knownAddresses: return self.knownAddresses[raw]
+
+        family = int.from_bytes(raw[0:2], sys.byteorder)
+        port = (raw[2]<<8)|raw[3]
+        if family == socket.AF_INET6: address = (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port)
+        else: address = (socket.inet_ntoa(raw[4:8]), port)
+
+        if len(self.knownAddresses) < 1000: self.knownAddresses[raw] = address
+        return address
+
+#
+# The SSRC of the sender of an AppleMIDI session control or clock sync
+# packet, or None if it's too short to have one.
+#
+def appleMidiSsrc(data):
+    if data[2:4] in (b'CK', b'RS'):
+        return int.from_bytes(data[4:8], 'big') if len(data) >= 8 else None
+    return int.from_bytes(data[12:16], 'big') if len(data) >= 16 else None
+
+#
+# pymidi's server, except that everything waiting on a socket is read in
+# one go (see datagramReceiver) and the ALSA output is drained once for the
+# lot. We also note when we last heard anything at all (MIDI, clock sync or
+# session control) from each peer, and unless fastDecode is turned off
+# MIDI data is decoded with parseMidiPacket() and handed straight to the
+# handler - pymidi is then only used for session control.
+#
+class hubServer(server.Server):
+    handler = None
+    fastDecode = True
+    receiver = None
+
+    def _loop_once(self, timeout=None):
+        if not self.receiver: self.receiver = datagramReceiver()
+
+        readable, _, _ = select.select(list(self.socket_map), [], [], timeout)
+        if not readable: return
+
+        now = time.time()
+        started = midiprofile.start()
+        if self.handler: self.handler.startBatch()
+        try:
+            for readySocket in readable:
+                for data, addr in self.receiver.receive(readySocket):
+                    if data[0:2] == b'\xff\xff':
+                        status = peerStatus.get(appleMidiSsrc(data))
+                        if status: status.lastHeard = now
+
+                    try: # One bad datagram mustn't stop the group
+                        if self.fastDecode and self.handler and data[0:2] != b'\xff\xff':
+                            decoded = parseMidiPacket(data)
+                            peer = self.handler.peers.get(decoded[0]) if decoded else None
+                            if peer:
+                                self.handler.on_midi_messages(peer, decoded[1], decoded[2])
+                                continue
+
+                        self.socket_map[readySocket].handle_message(bytes(data), addr)
+                    except Exception as e:
+                        logger.warning(f'Cannot handle datagram from {addr[0]}:{addr[1]}: {e}')
+        finally:
+            if self.handler: self.handler.endBatch()
+            if started: midiprofile.record('receive batch', started)
+
+    #
+    # Closes the session of any peer we haven't heard from for the
+    # sessionTimeout, just as if it had said goodbye, so that what it was
+    # holding is let go and pymidi will take an invitation from it again.
+    # We say goodbye (BY) on both of its ports too - if it is still there
+    # its MIDI software then shows the session as ended rather than
+    # carrying on sending to a session we no longer have.
+    #
+    def expireSessions(self):
+        if not stuckPolicy['sessionTimeout'] or not self.handler: return
+
+        now = time.time()
+        for ssrc in list(peerStatus):
+            if peerStatus[ssrc].silentFor(now) <= stuckPolicy['sessionTimeout']: continue
+
+            peer = self.handler.peers.get(ssrc)
+            logger.info(f'Session timed out: {peer}')
+            for protocol in self.socket_map.values():
+                if not isinstance(protocol, ControlProtocol) or ssrc not in protocol.peers_by_ssrc: continue
+
+                for sessionProtocol in (protocol, protocol.data_protocol):
+                    sessionPeer = sessionProtocol.peers_by_ssrc.get(ssrc) if sessionProtocol else None
+                    if not sessionPeer: continue
+                    try:
+                        sessionProtocol.sendto(b'\xff\xffBY'+struct.pack('>III', 2, 0, sessionProtocol.ssrc), sessionPeer.addr)
+                    except OSError as e:
+                        logger.warning(f'Cannot say goodbye to {sessionPeer}: {e}')
+                protocol._disconnect_peer(ssrc)
+
+            if ssrc in peerStatus: # pymidi didn't know about it
+                if peer: self.handler.on_peer_disconnected(peer)
+                else: peerStatus.pop(ssrc)
+
+#
+# Expression pedals, mod wheels and pitch bends can send hundreds of changes
+# a second. The first change for a controller goes straight out; any more in
+# the next "window" seconds replace each other and only the latest is sent
+# when the window is up. So the final value is never lost - only the steps
+# in between that nobody would hear. Note events flush anything waiting on
+# their channel first so that the order of things is kept.
+#
+class controllerThinner():
+    def __init__(self, alsaClient, window):
+        self.logger = logging.getLogger()
+        self.alsaClient = alsaClient
+        self.window = window
+        self.lastSent = {}
+        self.pending = {}
+
+    def output(self, key, event):
+        now = time.time()
+
+        if key not in self.pending and now-self.lastSent.get(key, 0) >= self.window:
+            self.alsaClient.event_output(event)
+            self.lastSent[key] = now
+        else:
+            self.pending[key] = event
+
+    #
+    # Sends whatever has waited a full window (or everything waiting on the
+    # channel given). Returns True if anything was sent so the caller can
+    # drain the output.
+    #
+    def flush(self, channel=None):
+        now = time.time()
+        sent = False
+
+        for key in list(self.pending):
+            if key[0] == channel or now-self.lastSent.get(key, 0) >= self.window:
+                self.alsaClient.event_output(self.pending.pop(key))
+                self.lastSent[key] = now
+                sent = True
+
+        return sent
+
+    #
+    # How long until the next pending change is due, for the main loop.
+    #
+    def nextTimeout(self):
+        if not self.pending: return loopTimeout
+
+        now = time.time()
+        return max(0, min([self.lastSent[key]+self.window-now for key in self.pending]))
+
+#
+# Remapping of channels, notes, velocities and controllers for the group,
+# worked out once at startup into lookup tables so that each event costs a
+# list index or two whatever is configured. None in a table means the event
+# is dropped. With no configuration every table maps a value to itself.
+# The configuration (the "transform" option) looks like:
+#  {"channels": {"0": 1, "9": null}, "transpose": -12, "noteRange": [21, 108],
+#   "velocityCurve": 0.7, "velocityRange": [20, 127], "controllers": {"1": 11},
+#   "drop": ["aftertouch"]}
+# velocityCurve is the power applied to the velocity (below 1 makes soft
+# playing louder; above 1 makes it quieter) before it is scaled to fit
+# velocityRange.
+#
+class midiTransform():
+    def __init__(self, config=None):
+        config = config or {}
+
+        self.channelMap = list(range(16))
+        for channel, newChannel in config.get('channels', {}).items():
+            self.channelMap[inRange('channel', channel, 0, 15)] = None if newChannel is None else inRange('channel', newChannel, 0, 15)
+
+        transpose = int(config.get('transpose', 0))
+        lowNote, highNote = [inRange('note', note, 0, 127) for note in config.get('noteRange', [0, 127])]
+        self.noteMap = [None]*128
+        for note in range(lowNote, highNote+1):
+            if 0 <= note+transpose <= 127: self.noteMap[note] = note+transpose
+
+        curve = float(config.get('velocityCurve', 1))
+        if curve <= 0: raise ValueError(f'velocityCurve {curve} must be more than 0')
+        lowVelocity, highVelocity = [inRange('velocity', velocity, 1, 127) for velocity in config.get('velocityRange', [1, 127])]
+        self.velocityMap = [0]*128 # Velocity zero (really a NoteOff) stays that way
+        for velocity in range(1, 128):
+            self.velocityMap[velocity] = round(lowVelocity+(highVelocity-lowVelocity)*(((velocity-1)/126)**curve))
+
+        self.controllerMap = list(range(128))
+        for controller, newController in config.get('controllers', {}).items():
+            self.controllerMap[inRange('controller', controller, 0, 127)] = None if newController is None else inRange('controller', newController, 0, 127)
+
+        self.dropStatus = {status for status in commandNames if commandNames[status] in config.get('drop', [])}
+
+#
+# Checks a channel, note, velocity or controller from the transform
+# configuration so that a bad one stops the transform being used rather
+# than turning up in the middle of a MIDI message. Velocities start at 1 as
+# a NoteOn with velocity zero is really a NoteOff.
+#
+def inRange(name, value, low, high):
+    number = int(value)
+    if not low <= number <= high: raise ValueError(f'{name} {value} is not between {low} and {high}')
 
-        for channel in range(16):
-            pitchWheelTime = self.channelInfo[channel]['pitchWheelTime']
-            if pitchWheelTime:
-                if now - pitchWheelTime > noteTimeout:
-                    self.logger.info(f'Pitch wheel stuck on channel {channel} - resetting')
-                    alsaClient.event_output(alsa_midi.PitchBendEvent(value=defaultPitchWheel, channel=channel))
-                    alsaClient.drain_output()
-                    self.channelInfo[channel]['pitchWheelTime'] = None
-
-            for noteNumber in range(128):
-                noteOnTime = self.channelInfo[channel]['noteOnTime'][noteNumber]
-                if noteOnTime:
-                    if now - noteOnTime > noteTimeout:
-                        self.logger.info(f'Note {noteNumber} stuck on channel {channel} - resetting')
-                        alsaClient.event_output(alsa_midi.NoteOffEvent(note=noteNumber, velocity=64, channel=channel))
-                        alsaClient.drain_output()
-                        self.channelInfo[channel]['noteOnTime'][noteNumber] = None
+    return number
+
+#
+# Records everything the group plays to Standard MIDI Files. The forwarding
+# code only ever puts the time and the three MIDI bytes into slots that were
+# set aside at startup - it never waits for anything, and if the writer has
+# fallen so far behind that the buffer is full the event just isn't
+# recorded. A separate thread wakes up every few seconds and writes what has
+# arrived in one go, keeping the file valid (end of track marker and track
+# length) after every write so a crash loses at most a few seconds. A new
+# file is started every "rotateMinutes".
+# The configuration (the "record" option) is true or:
+#  {"directory": "../recordings", "rotateMinutes": 60, "flushSeconds": 5, "bufferSize": 65536}
+#
+class midiRecorder():
+    ticksPerQuarter = 500 # With the default tempo (120bpm) a tick is 1ms
+    endOfTrack = b'\x00\xff\x2f\x00'
+    trackStart = b'\x00\xff\x51\x03\x07\xa1\x20' # Tempo 500000us per quarter
+
+    def __init__(self, name, config):
+        config = config if isinstance(config, dict) else {}
+
+        self.logger = logging.getLogger()
+        self.name = name
+        self.directory = config.get('directory', '../recordings')
+        self.rotateSeconds = float(config.get('rotateMinutes', 60))*60
+        self.flushSeconds = float(config.get('flushSeconds', 5))
+        self.size = int(config.get('bufferSize', 65536))
+
+        self.times = [0.0]*self.size
+        self.messages = bytearray(self.size*3)
+        self.head = 0 # Only changed by record()
+        self.tail = 0 # Only changed by the writer thread
+        self.dropped = 0
+
+        self.file = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self.writer, daemon=True).start()
+
+    def record(self, status, data1, data2):
+        head = self.head
+        if head-self.tail >= self.size:
+            self.dropped += 1
+            return
+
+        index = head%self.size
+        self.times[index] = time.monotonic()
+        self.messages[index*3] = status
+        self.messages[index*3+1] = data1
+        self.messages[index*3+2] = data2
+        self.head = head+1
+
+    def writer(self):
+        while not self.stopped.wait(self.flushSeconds):
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f'Recording failed: {e}')
+
+    def flush(self):
+        with self.lock:
+            head = self.head
+            if head == self.tail: return
+
+            if self.file and time.monotonic()-self.fileStarted >= self.rotateSeconds:
+                self.closeFile()
+            if not self.file:
+                self.openFile(self.times[self.tail%self.size])
+
+            track = bytearray()
+            for position in range(self.tail, head):
+                index = position%self.size
+                ticks = max(0, round((self.times[index]-self.lastTime)*1000))
+                self.lastTime = self.times[index]
+
+                delta = ticks&0x7f # Variable length quantity
+                ticks >>= 7
+                while ticks:
+                    delta = (delta<<8)|0x80|(ticks&0x7f)
+                    ticks >>= 7
+                while True:
+                    track.append(delta&0xff)
+                    if not delta&0x80: break
+                    delta >>= 8
+
+                length = 2 if self.messages[index*3]&0xf0 in (0xc0, 0xd0) else 3
+                track += self.messages[index*3:index*3+length]
+            self.tail = head
+
+            self.trackLength += len(track)
+            self.file.seek(-len(self.endOfTrack), os.SEEK_END)
+            self.file.write(track+self.endOfTrack)
+            self.file.seek(18)
+            self.file.write(struct.pack('>I', self.trackLength))
+            self.file.flush()
+
+            if self.dropped:
+                self.logger.warning(f'Recording buffer full - {self.dropped} events not recorded')
+                self.dropped = 0
+
+    def openFile(self, firstTime):
+        fileName = f'{self.directory}/{self.name}-{time.strftime("%Y%m%d-%H%M%S")}.mid'
+        self.logger.info(f'Recording to {fileName}')
+
+        self.file = open(fileName, 'wb')
+        self.file.write(b'MThd'+struct.pack('>IHHH', 6, 0, 1, self.ticksPerQuarter))
+        self.file.write(b'MTrk'+struct.pack('>I', 0))
+        self.file.write(self.trackStart+self.endOfTrack)
+
+        self.trackLength = len(self.trackStart)+len(self.endOfTrack)
+        self.fileStarted = time.monotonic()
+        self.lastTime = firstTime
+
+    def closeFile(self):
+        self.file.close()
+        self.file = None
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+        with self.lock:
+            if self.file: self.closeFile()
+
+#
+# Sits between us and ALSA so that a slow or wedged reader of our port (an
+# rtpmidi daemon that has stopped taking events) can't hold everyone up.
+# SequencerClient's own event_output() and drain_output() wait (in poll())
+# for as long as it takes when the kernel's buffer for the port is full, so
+# we go through SequencerClientBase's, which give up with -EAGAIN instead.
+# Events aren't published to our subscribers: if one of them refused an
+# event the others would already have it and sending it again would play
+# it twice. Instead each subscriber (looked up every subscriberInterval
+# seconds) is sent its own copy, and what one won't take waits in a queue
+# of its own and is retried every time around the main loop while the
+# others carry on. Each queue has room for "limit" events. After that,
+# changes (controllers, pitch bend and aftertouch - but not pedals and
+# other switches) give way first: with the "coalesce" policy a new value
+# replaces one that is waiting for the same thing, otherwise (or with the
+# "drop" policy) the new change is dropped. Anything else pushes out the
+# oldest waiting change. If there are none a new NoteOn is dropped, but
+# NoteOffs, pedals and the like never are even if that means going over
+# the limit. How many events were dropped or coalesced goes into the
+# heartbeat for "midihub.py status".
+# It is off unless the "outputQueue" option is set, to true for the
+# defaults or to something like:
+#  {"limit": 1024, "policy": "coalesce"}
+#
+class queuedOutput():
+    def __init__(self, alsaClient, port, config=None):
+        config = config if isinstance(config, dict) else {}
+
+        self.logger = logging.getLogger()
+        self.alsaClient = alsaClient
+        self.port = port
+        self.limit = int(config.get('limit', 1024))
+        self.policy = config.get('policy', 'coalesce')
+        self.destinations = []
+        self.lastLookup = 0
+        self.queues = {}
+        self.buffered = [] # (destination, event) in ALSA's output buffer, in order
+        self.eventSize = alsa_midi.ffi.sizeof('snd_seq_event_t')
+        self.dropped = 0
+        self.coalesced = 0
+        self.lastReport = (0, 0)
+
+    #
+    # Finds out who is subscribed to our port. Called from the main loop.
+    #
+    def lookupDestinations(self):
+        self.lastLookup = time.time()
+
+        try:
+            subscribers = self.alsaClient.list_port_subscribers(self.port, alsa_midi.SubscriptionQueryType.READ)
+        except alsa_midi.ALSAError as e:
+            self.logger.warning(f'Cannot list subscribers: {e}')
+            return
+
+        self.destinations = [alsa_midi.Address(*subscriber.addr) for subscriber in subscribers]
+        for destination in list(self.queues):
+            if destination in self.destinations: continue
+            self.logger.info(f'{destination} unsubscribed - dropping {len(self.queues[destination])} events waiting for it')
+            self.dropped += len(self.queues.pop(destination))
+
+    def event_output(self, event):
+        for destination in self.destinations:
+            if destination not in self.queues:
+                try:
+                    self.buffer(destination, event)
+                    continue
+                except alsa_midi.ALSAError as e:
+                    self.refused(e)
+
+            self.enqueue(self.queues.setdefault(destination, collections.deque()), event)
+
+    def buffer(self, destination, event):
+        SequencerClientBase.event_output_buffer(self.alsaClient, event, port=self.port, dest=destination)
+        self.buffered.append((destination, event))
+
+    #
+    # ALSA wouldn't take any more. Anything still in its output buffer (from
+    # the event it refused on) goes back to the front of the queue for its
+    # destination, in order, so that nothing is sent twice or lost. Returns
+    # the destination that refused.
+    #
+    def refused(self, error):
+        unsent = SequencerClientBase.event_output_pending(self.alsaClient)//self.eventSize
+        waiting = self.buffered[len(self.buffered)-unsent:] if unsent else []
+        self.alsaClient.drop_output_buffer()
+        self.buffered = []
+
+        for destination, event in reversed(waiting):
+            self.queues.setdefault(destination, collections.deque()).appendleft(event)
+        if not waiting: return None
+
+        destination = waiting[0][0]
+        if error.errnum != -errno.EAGAIN:
+            self.logger.warning(f'Cannot send {waiting[0][1]} to {destination}: {error}')
+            self.queues[destination].popleft()
+            if not self.queues[destination]: del self.queues[destination]
+            self.dropped += 1
+        return destination
+
+    def enqueue(self, queue, event):
+        if len(queue) >= self.limit and not self.makeRoom(queue, event): return
+        queue.append(event)
+
+    #
+    # Returns True if the event should still be added to the queue.
+    #
+    def makeRoom(self, queue, event):
+        key = changeKey(event)
+
+        if key:
+            if self.policy == 'coalesce':
+                for index, waiting in enumerate(queue):
+                    if changeKey(waiting) == key:
+                        queue[index] = event
+                        self.coalesced += 1
+                        return False
+            self.dropped += 1
+            return False
+
+        for index, waiting in enumerate(queue):
+            if changeKey(waiting):
+                del queue[index]
+                self.dropped += 1
+                return True
+
+        if not isinstance(event, alsa_midi.NoteOnEvent) or not event.velocity: return True
+
+        self.dropped += 1
+        return False
+
+    #
+    # Sends everything buffered, and whatever is waiting for destinations
+    # that will take it. Each time a destination refuses it is left alone
+    # until next time and the rest are tried again.
+    #
+    def drain_output(self):
+        skipped = set()
+
+        while True:
+            try:
+                for destination in list(self.queues):
+                    if destination in skipped: continue
+                    queue = self.queues[destination]
+                    while queue:
+                        self.buffer(destination, queue[0])
+                        queue.popleft()
+                    del self.queues[destination]
+
+                SequencerClientBase.drain_output(self.alsaClient)
+                self.buffered = []
+                return
+            except alsa_midi.ALSAError as e:
+                destination = self.refused(e)
+                if destination is None: return
+                if e.errnum == -errno.EAGAIN:
+                    if destination in skipped: return
+                    skipped.add(destination)
+
+    #
+    # True while anything is waiting for a destination.
+    #
+    def waiting(self):
+        return bool(self.queues)
+
+    #
+    # Logs any overflow since last time. Called from the main loop.
+    #
+    def report(self):
+        if (self.dropped, self.coalesced) == self.lastReport: return
+
+        waiting = ', '.join(f'{len(self.queues[destination])} for {destination}' for destination in self.queues)
+        self.logger.warning(f'Output queue full ({waiting or "nothing"} waiting) - {self.dropped-self.lastReport[0]} events dropped'
+                            f' and {self.coalesced-self.lastReport[1]} coalesced')
+        self.lastReport = (self.dropped, self.coalesced)
+
+    #
+    # On the way out - keep trying for a little while to get everything out.
+    #
+    def close(self, timeout=1):
+        endTime = time.time()+timeout
+        self.drain_output()
+        while self.waiting() and time.time() < endTime:
+            time.sleep(0.01)
+            self.drain_output()
+
+#
+# What a controller, pitch bend or aftertouch event changes, so that two
+# values for the same thing can be recognised. None for everything else.
+#
+def changeKey(event):
+    if isinstance(event, alsa_midi.ControlChangeEvent):
+        if event.param in unthinnedControllers: return None
+        return ('controller', event.channel, event.param)
+    if isinstance(event, alsa_midi.PitchBendEvent): return ('pitch', event.channel)
+    if isinstance(event, alsa_midi.KeyPressureEvent): return ('aftertouch', event.channel, event.note)
+    if isinstance(event, alsa_midi.ChannelPressureEvent): return ('pressure', event.channel)
+    return None
+
+#
+# So that midihub can tell we're alive (and not just running) we write our
+# process id, the time, the number of packets we've handled and the number
+# of events that didn't fit in the output queue into a tiny memory-mapped
+# file every time around the main loop. If we get stuck the time stops
+# moving.
+#
+class heartbeat():
+    def __init__(self, fileName):
+        fd = os.open(fileName, os.O_RDWR|os.O_CREAT, 0o644)
+        os.ftruncate(fd, 32)
+        self.memory = mmap.mmap(fd, 32)
+        os.close(fd)
+
+        self.pid = os.getpid()
+        self.packets = 0
+        self.overflows = 0
+        self.beat()
+
+    def beat(self):
+        struct.pack_into('<QQQQ', self.memory, 0, self.pid, int(time.time()*1000), self.packets, self.overflows)
 
 class MyHandler(server.Handler):
-    def __init__(self, alsa):
+    def __init__(self, alsa, thinner=None, transform=None, recorder=None, heartbeat=None):
         self.logger = logging.getLogger()
         self.alsaClient = alsa
+        self.thinner = thinner
+        self.transform = transform or midiTransform()
+        self.recorder = recorder
+        self.heartbeat = heartbeat
+        self.peers = {}
+        self.batching = False
+        self.outputPending = False
 
     def on_peer_connected(self, peer):
         self.logger.info(f'Peer connected: {peer}')
-        peerStatus[peer.name] = peerInfo(peer.name)
+        peerStatus[peer.ssrc] = peerInfo(peer.name)
+        self.peers[peer.ssrc] = peer
 
+    #
+    # Lets go of exactly what this peer was holding. Thinned changes still
+    # waiting on its channels go out first so they can't undo the reset.
+    #
     def on_peer_disconnected(self, peer):
         self.logger.info(f'Peer disconnected: {peer}')
-        peerStatus.pop(peer.name, None)
+        self.peers.pop(peer.ssrc, None)
+        status = peerStatus.pop(peer.ssrc, None)
+        if not status: return
+
+        if self.thinner:
+            for channel in {channel for channel, _ in status.pedals} | set(status.pitchWheels):
+                self.thinner.flush(channel)
+        if status.heldNotes or status.pedals or status.pitchWheels:
+            self.logger.info(f'Releasing {len(status.heldNotes)} notes, {len(status.pedals)} pedals and'
+                             f' {len(status.pitchWheels)} pitch wheels held by {peer.name}')
+        status.releaseAll(self.alsaClient)
 
     def on_midi_commands(self, peer, midi_packet):
-        for command in midi_packet.command.midi_list:
-            self.logger.info(f'{peer.name} sent {command.command}')
-
-            event = None
-            if command.command == 'note_on':
-                event = alsa_midi.NoteOnEvent(note=command.params.key, velocity=command.params.velocity, channel=command.channel)
-                peerStatus[peer.name].noteOn(command.channel, command.params.key)
-            elif command.command == 'note_off':
-                event = alsa_midi.NoteOffEvent(note=command.params.key, velocity=command.params.velocity, channel=command.channel)
-                peerStatus[peer.name].noteOff(command.channel, command.params.key)
-            elif command.command == 'aftertouch':
-                event = alsa_midi.KeyPressureEvent(note=command.params.key, velocity=command.params.touch, channel=command.channel)
-            elif command.command == 'pitch_bend_change':
-                pitchWheelValue = command.params.msb*256+command.params.lsb
-                event = alsa_midi.PitchBendEvent(value=pitchWheelValue, channel=command.channel)
-                peerStatus[peer.name].pitchWheel(command.channel)
-            elif command.command == 'control_mode_change':
-                event = alsa_midi.ControlChangeEvent(param=command.params.controller, value=command.params.value, channel=command.channel)
+        self.on_midi_messages(peer, midi_packet.header.rtp_header.sequence_number, pymidiMessages(midi_packet))
+
+    #
+    # Sends on a packet's worth of (status, data1, data2) messages, from
+    # either pymidi or parseMidiPacket().
+    #
+    def on_midi_messages(self, peer, sequenceNumber, messages):
+        channelMap = self.transform.channelMap
+        noteMap = self.transform.noteMap
+        velocityMap = self.transform.velocityMap
+        controllerMap = self.transform.controllerMap
+        dropStatus = self.transform.dropStatus
+        status = peerStatus[peer.ssrc]
+        started = midiprofile.start()
+
+        if self.heartbeat: self.heartbeat.packets += 1
+        status.packet(sequenceNumber)
+
+        for command, data1, data2 in messages:
+            kind = command&0xf0
+            self.logger.info(f'{peer.name} sent {commandNames.get(kind, hex(command))}')
+
+            channel = channelMap[command&0x0f]
+            if channel is None or kind in dropStatus: continue
+
+            if kind == 0x90:
+                note = noteMap[data1]
+                if note is None: continue
+                data1, data2 = note, velocityMap[data2]
+                event = alsa_midi.NoteOnEvent(note=note, velocity=data2, channel=channel)
+                if data2: status.noteOn(channel, note)
+                else: status.noteOff(channel, note)
+            elif kind == 0x80:
+                note = noteMap[data1]
+                if note is None: continue
+                data1 = note
+                event = alsa_midi.NoteOffEvent(note=note, velocity=data2, channel=channel)
+                status.noteOff(channel, note)
+            elif kind == 0xa0:
+                note = noteMap[data1]
+                if note is None: continue
+                data1 = note
+                event = alsa_midi.KeyPressureEvent(note=note, velocity=data2, channel=channel)
+            elif kind == 0xe0:
+                event = alsa_midi.PitchBendEvent(value=((data2<<7)|data1)-0x2000, channel=channel)
+                status.pitchWheel(channel)
+            elif kind == 0xb0:
+                controller = controllerMap[data1]
+                if controller is None: continue
+                data1 = controller
+                event = alsa_midi.ControlChangeEvent(param=controller, value=data2, channel=channel)
+                if controller in pedalControllers: status.pedal(channel, controller, data2)
+            elif kind == 0xc0:
+                event = alsa_midi.ProgramChangeEvent(value=data1, channel=channel)
+            elif kind == 0xd0:
+                event = alsa_midi.ChannelPressureEvent(value=data1, channel=channel)
             else:
-                self.logger.warning(f'Unknown command: {command.command}')
-                self.logger.warning(command)
+                continue
+
+            self.logger.info(event)
+            if self.recorder: self.recorder.record(kind|channel, data1, data2)
+
+            if self.thinner:
+                if kind == 0xe0:
+                    self.thinner.output((channel, 'pitch'), event)
+                    continue
+                if kind == 0xb0 and data1 not in unthinnedControllers:
+                    self.thinner.output((channel, data1), event)
+                    continue
+                self.thinner.flush(channel)
+
+            self.alsaClient.event_output(event)
 
-            if event:
-                self.logger.info(event)
-                self.alsaClient.event_output(event)
+        if self.batching: self.outputPending = True
+        else: self.alsaClient.drain_output()
 
+        if started: midiprofile.record('packet', started)
+
+    #
+    # While the server is working through a batch of datagrams the output
+    # is only drained once, at the end.
+    #
+    def startBatch(self):
+        self.batching = True
+
+    def endBatch(self):
+        self.batching = False
+        if self.outputPending:
+            self.outputPending = False
             self.alsaClient.drain_output()
 
 def rawServer(midiPort, midiName):
+    global alsaClient, recorder
+
     alsaClient = alsa_midi.SequencerClient(midiName)
     alsaPort = alsaClient.create_port(midiName)
 
-    myServer = server.Server([('0.0.0.0', midiPort)])
-    myServer.add_handler(MyHandler(alsaClient))
+    output = None
+    if daemonOptions.get('outputQueue'):
+        output = queuedOutput(alsaClient, alsaPort, daemonOptions.get('outputQueue'))
+        logger.info(f'Output queue of {output.limit} events ({output.policy})')
+        alsaClient = output
+
+    thinner = None
+    if daemonOptions.get('coalesceWindow'):
+        logger.info(f'Thinning controllers over {daemonOptions["coalesceWindow"]} ms')
+        thinner = controllerThinner(alsaClient, daemonOptions['coalesceWindow']/1000)
+
+    transform = None
+    if daemonOptions.get('transform'):
+        try:
+            transform = midiTransform(daemonOptions['transform'])
+            logger.info(f'Transforming with {daemonOptions["transform"]}')
+        except Exception as e:
+            logger.error(f'Transform {daemonOptions["transform"]} not valid - ignoring: {e}')
+
+    if daemonOptions.get('record'):
+        recorder = midiRecorder(midiName, daemonOptions['record'])
+
+    pulse = None
+    if daemonOptions.get('heartbeatDirectory'):
+        pulse = heartbeat(f'{daemonOptions["heartbeatDirectory"]}/{midiName}.heartbeat')
+
+    stuckPolicy.update(daemonOptions.get('stuckNotes', {}))
+    logger.info(f'Stuck notes policy: {stuckPolicy}')
+
+    myServer = hubServer([('0.0.0.0', midiPort)])
+    handler = MyHandler(alsaClient, thinner, transform, recorder, pulse)
+    myServer.add_handler(handler)
+    myServer.handler = handler
+    myServer.fastDecode = daemonOptions.get('fastDecode', True)
 
     myServer._init_protocols()
+    if daemonOptions.get('readyFd'): signalReady(daemonOptions['readyFd'])
 
     while True:
-        myServer._loop_once(timeout=0.5)
-        for peerName in peerStatus:
-            peerStatus[peerName].checkForStuck(alsaClient)
+        timeout = thinner.nextTimeout() if thinner else loopTimeout
+        if output:
+            if time.time()-output.lastLookup >= subscriberInterval: output.lookupDestinations()
+            timeout = min(timeout, outputRetryTimeout if output.waiting() else subscriberInterval)
+
+        myServer._loop_once(timeout=timeout)
+        if thinner and thinner.flush(): alsaClient.drain_output()
+        if output:
+            if output.waiting(): output.drain_output()
+            output.report()
+            if pulse: pulse.overflows = output.dropped+output.coalesced
+        if pulse: pulse.beat()
+
+        started = midiprofile.start()
+        myServer.expireSessions()
+        for ssrc in peerStatus:
+            peerStatus[ssrc].checkForStuck(alsaClient)
+        if started: midiprofile.record('stuck note sweep', started)
+
+#
+# midihub gives us the write end of a pipe so that it can connect our ALSA
+# port as soon as we're listening rather than on its next check.
+#
+def signalReady(fd):
+    global logger
+
+    try:
+        os.write(fd, b'ready\n')
+        os.close(fd)
+    except OSError as e:
+        logger.warning(f'Cannot tell midihub we are ready: {e}')
+
+#
+# Keep all of our memory in RAM so that a page fault never holds up a note.
+# midihub asks for this in MIDIHUB_OPTIONS; it only works if the memlock
+# limit for the user allows it.
+#
+def lockMemory():
+    global logger
+
+    MCL_CURRENT = 1
+    MCL_FUTURE = 2
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT|MCL_FUTURE) != 0:
+        logger.warning(f'Cannot lock memory: {os.strerror(ctypes.get_errno())}')
+    else:
+        logger.info('Memory locked')
 
 def interrupted(signal, frame):
     global logger
 
     logger.info('Interrupt - stopping')
+    if recorder: recorder.close()
+    sys.exit(0)
+
+#
+# midihub sends SIGTERM when our group has been removed from the
+# configuration. Let go of any held notes on the way out.
+#
+def terminated(signal, frame):
+    global logger, alsaClient
+
+    logger.info('Terminated - releasing held notes and stopping')
+    if alsaClient:
+        for ssrc in peerStatus:
+            peerStatus[ssrc].releaseAll(alsaClient)
+        if isinstance(alsaClient, queuedOutput): alsaClient.close()
+    if recorder: recorder.close()
+
     sys.exit(0)
 
 if __name__ == '__main__':
@@ -141,5 +1160,14 @@ if __name__ == '__main__':
     logger.setLevel(logging.INFO)
 
     signal.signal(signal.SIGINT, interrupted)
+    signal.signal(signal.SIGTERM, terminated)
+    midiprofile.install(sys.argv[1], logger)
+
+    try:
+        daemonOptions = json.loads(os.environ.get('MIDIHUB_OPTIONS', '{}'))
+    except Exception as e:
+        logger.warning(f'Cannot read MIDIHUB_OPTIONS - ignoring: {e}')
+
+    if daemonOptions.get('lockMemory'): lockMemory()
 
     rawServer(int(sys.argv[1]), sys.argv[2])
\ No newline at end of file
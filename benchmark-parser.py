@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+#
+# benchmark-parser.py
+#  Compares how long it takes to decode RTP MIDI packets with pymidi (which
+#  alsaserver.py used to do for every packet) and with alsaserver's own
+#  parseMidiPacket(). Run it from the pymidi directory (the CloudFormation
+#  template copies it there along with alsaserver.py) so that both can be
+#  imported:
+#   cd ~/pymidi && ./benchmark-parser.py [iterations]
+#  Also checks that both give the same messages for each packet.
+#
+
+import sys
+import timeit
+from pymidi import packets
+import alsaserver
+
+#
+# RTP header (version 2, payload type 0x61) with the given sequence number
+# followed by the MIDI command section.
+#
+def rtpMidi(sequenceNumber, midiList, zFlag=False):
+    header = bytes([0x80, 0x61, sequenceNumber>>8, sequenceNumber&0xff, 0, 0, 0, 0, 0x12, 0x34, 0x56, 0x78])
+    flags = 0x20 if zFlag else 0
+    if len(midiList) > 15:
+        return header+bytes([0x80|flags|(len(midiList)>>8), len(midiList)&0xff])+midiList
+    return header+bytes([flags|len(midiList)])+midiList
+
+samplePackets = {
+    'single note': rtpMidi(1, bytes([0x90, 60, 100])),
+    'four note chord (running status)': rtpMidi(2, bytes([0x90, 60, 100, 0, 64, 100, 0, 67, 100, 0, 72, 100])),
+    'chord release': rtpMidi(3, bytes([0x80, 60, 64, 0, 0x80, 64, 64, 0, 0x80, 67, 64, 0, 0x80, 72, 64])),
+    'controller sweep': rtpMidi(4, bytes([0xb0, 11, 0]+[byte for value in range(1, 20) for byte in (0x81, 0x00, 11, value)])),
+}
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    for name in samplePackets:
+        data = samplePackets[name]
+
+        pymidiResult = alsaserver.pymidiMessages(packets.MIDIPacket.parse(data))
+        fastResult = alsaserver.parseMidiPacket(data)[2]
+        if [tuple(int(value) for value in message) for message in pymidiResult] != fastResult:
+            print(f'{name}: results differ\n pymidi {pymidiResult}\n fast   {fastResult}')
+
+        pymidiTime = timeit.timeit(lambda: alsaserver.pymidiMessages(packets.MIDIPacket.parse(data)), number=iterations)
+        fastTime = timeit.timeit(lambda: alsaserver.parseMidiPacket(data), number=iterations)
+
+        print(f'{name:35} {len(fastResult):3} messages  pymidi {pymidiTime/iterations*1e6:8.2f}us  '
+              f'fast {fastTime/iterations*1e6:6.2f}us  {pymidiTime/fastTime:5.1f}x')
+
+if __name__ == '__main__':
+    main()
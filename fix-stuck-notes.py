@@ -13,6 +13,8 @@ import os
 import sys
 import signal
 import alsa_midi
+import midiconfig
+import midiprofile
 
 sqs = boto3.client('sqs')
 cfn = boto3.client('cloudformation')
@@ -24,13 +26,17 @@ sqsQueueUrl = None
 logger = None
 alsaClients = {}
 alsaPorts = {}
+portsFileTime = None
+reloadRequested = False
+backgroundScheduling = None
 
-portRanges = {'Low':range(0, 43), 'Mid':range(43, 86), 'High':range(86, 127), 'All':range(0, 127)}
+portRanges = midiconfig.noteRanges
 
 def main():
     global logger, sqsQueueUrl, transmitPorts, alsaClients, portRanges
 
     signal.signal(signal.SIGINT, interrupted)
+    signal.signal(signal.SIGHUP, reloadSignalled)
 
     logging.basicConfig()
     logger = logging.getLogger()
@@ -41,9 +47,14 @@ def main():
         sys.exit(0)
 
     configure()
+    midiprofile.install('fix-stuck-notes', logger)
 
     while True:
+        if reloadRequested or portsFileChanged(): readPorts()
+
+        started = midiprofile.start()
         connectMidiPorts()
+        if started: midiprofile.record('connectMidiPorts', started)
 
         try:
             messageList = sqs.receive_message(QueueUrl=sqsQueueUrl, WaitTimeSeconds=2, MaxNumberOfMessages=1).get('Messages', [])
@@ -56,6 +67,7 @@ def main():
 
             resetRange = body['range']
             port = int(body['port'])
+            started = midiprofile.start()
 
             if port not in alsaClients:
                 logger.warning(f'Port {port} is not defined - skipping')
@@ -73,6 +85,8 @@ def main():
                         if not chan%8: alsaClients[port].drain_output()
                     alsaClients[port].drain_output()
 
+            if started: midiprofile.record('reset', started)
+
             try:
                 sqs.delete_message(QueueUrl=sqsQueueUrl, ReceiptHandle=message['ReceiptHandle'])
             except Exception as e:
@@ -108,24 +122,7 @@ def connectMidiPorts():
             logger.warning(f'Did not find destination for port {portNumber}')
 
 def configure():
-    global logger, midiPorts, transmitPorts, sqsQueueUrl, tableName, alsaClients
-
-    try:
-        with open('midiports') as portsFile:
-            portsList = portsFile.read()
-
-        midiPorts = json.loads(portsList)
-    except FileNotFoundError: # No ports file found - that's quite ok
-        logger.error('No ports file found - stopping')
-        sys.exit(1)
-    except Exception as e:
-        logger.error(f'Got error {e} - ports file badly formatted?')
-        sys.exit(1)
-
-    for group in midiPorts:
-        transmitPorts.append(midiPorts[group][1])
-
-    logger.info(f'MIDI ports: {midiPorts} Transmit ports: {transmitPorts}')
+    global logger, sqsQueueUrl, tableName
 
     try:
         with open('../cloudformationstackname') as cfnfile:
@@ -154,12 +151,64 @@ def configure():
         logger.error('Did not find SQS queue URL')
         sys.exit(1)
 
+    if not readPorts():
+        sys.exit(1)
+
+    midiconfig.applyScheduling(backgroundScheduling, logger)
+
+#
+# Reads the ports file at startup and again whenever it changes (or we get
+# SIGHUP) so that groups added or removed while midihub.py is running are
+# reset too. If a later read fails we keep the ports we already have.
+# Returns False if the file couldn't be used.
+#
+def readPorts():
+    global logger, midiPorts, transmitPorts, tableName, alsaClients, alsaPorts, portsFileTime, reloadRequested, backgroundScheduling
+
+    reloadRequested = False
+    try:
+        portsFileTime = os.path.getmtime('midiports')
+        midiConfig = midiconfig.readMidiPorts()
+        newPorts = midiconfig.getGroups(midiConfig)
+        newScheduling = midiconfig.getScheduling(midiConfig, 'background')
+    except FileNotFoundError: # No ports file found - that's quite ok
+        logger.error('No ports file found' + (' - stopping' if not midiPorts else ' - keeping current ports'))
+        return False
+    except Exception as e:
+        logger.error(f'Got error {e} - ports file badly formatted?' + ('' if not midiPorts else ' - keeping current ports'))
+        return False
+
+    if backgroundScheduling is None: # Applied once by configure() - nice is relative
+        backgroundScheduling = newScheduling
+    elif newScheduling != backgroundScheduling:
+        logger.warning('Background scheduling changed - restart fix-stuck-notes.py to apply it')
+
+    newTransmitPorts = [newPorts[group][1] for group in newPorts]
+    if newPorts == midiPorts: return True
+
+    for portNumber in transmitPorts:
+        if portNumber in newTransmitPorts or portNumber not in alsaClients: continue
+        alsaClients.pop(portNumber).close()
+        del alsaPorts[portNumber]
+
+    midiPorts = newPorts
+    transmitPorts = newTransmitPorts
+    logger.info(f'MIDI ports: {midiPorts} Transmit ports: {transmitPorts}')
+
     dynamodb = boto3.resource('dynamodb').Table(tableName)
     try:
         dynamodb.put_item(Item={'clientId':'TransmitPorts','list':transmitPorts})
     except Exception as e:
         logger.warning(f'Failed to save transmit ports to DynamoDB - continuing: {e}')
 
+    return True
+
+def portsFileChanged():
+    try:
+        return os.path.getmtime('midiports') != portsFileTime
+    except OSError:
+        return False
+
 #
 # Although it's not completely harmful we don't really want more than one
 # copy of this running at any one time. The worst that can happen is that
@@ -177,6 +226,11 @@ def alreadyRunning():
 
     return False
 
+def reloadSignalled(signal, frame):
+    global reloadRequested
+
+    reloadRequested = True
+
 def interrupted(signal, frame):
     global logger
 
@@ -2,10 +2,25 @@ import json
 import boto3
 import os
 import logging
+import concurrent.futures
 
-dynamodb = boto3.client('dynamodb')
+#
+# Returns the latency figures for every client from this hub's table. Called
+# as /latency?view=hubs it instead reads the tables of this hub and every
+# hub in OtherHubs (a comma separated list of region:stackname, for example
+# "ap-southeast-1:MidiHub-Singapore,us-west-2:MidiHub-Oregon") at the same
+# time and returns each participant with the hubs they have used ranked by
+# average latency, fastest first. DynamoDBEndpoint can point at a local
+# DynamoDB for testing.
+#
+
+dynamodbEndpoint = os.environ.get('DynamoDBEndpoint') or None
+dynamodb = boto3.client('dynamodb', endpoint_url=dynamodbEndpoint)
 
 tableName = os.environ.get('TableName')
+hubName = os.environ.get('HubName', 'This hub')
+otherHubs = os.environ.get('OtherHubs', '')
+hubClients = {}
 
 logging.basicConfig()
 logger = logging.getLogger()
@@ -18,8 +33,16 @@ def lambda_handler(event, context):
         logger.error('TableName not set - stopping')
         return {'statusCode':500, 'body':'TableName not set'}
 
-    paginator = dynamodb.get_paginator('scan')
-    iterator = paginator.paginate(TableName=tableName)
+    parameters = (event or {}).get('queryStringParameters') or {}
+    if parameters.get('view') == 'hubs': return hubView()
+
+    return readTable(dynamodb, tableName)
+
+def readTable(client, table):
+    global logger
+
+    paginator = client.get_paginator('scan')
+    iterator = paginator.paginate(TableName=table)
 
     output = []
     for page in iterator:
@@ -49,4 +72,60 @@ def lambda_handler(event, context):
 
             output.append(item)
 
-    return(output)
\ No newline at end of file
+    return(output)
+
+#
+# The (DynamoDB client, table name) for each hub, this one first. Clients
+# for other regions are kept between invocations.
+#
+def getHubs():
+    global hubClients
+
+    hubs = {hubName:(dynamodb, tableName)}
+
+    for entry in otherHubs.split(','):
+        if not entry.strip(): continue
+
+        region, _, stackName = entry.strip().partition(':')
+        if region not in hubClients:
+            hubClients[region] = boto3.client('dynamodb', region_name=region, endpoint_url=dynamodbEndpoint)
+        hubs[stackName] = (hubClients[region], f'midiHubv2-{stackName}')
+
+    return hubs
+
+def hubView():
+    global logger
+
+    hubs = getHubs()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(hubs)) as executor:
+        futures = {hub:executor.submit(readTable, *hubs[hub]) for hub in hubs}
+
+    hubStatus = {}
+    participants = {}
+    for hub in futures:
+        try:
+            items = futures[hub].result()
+        except Exception as e:
+            logger.error(f'Cannot read table for hub {hub}: {e}')
+            hubStatus[hub] = str(e)
+            continue
+
+        hubStatus[hub] = 'ok'
+        for item in items:
+            try:
+                latency = float(item['averageLatency'])
+            except ValueError:
+                continue
+
+            best = participants.setdefault(item['clientName'], {}).get(hub)
+            if best and best['averageLatency'] <= latency: continue # Same person on another port
+
+            participants[item['clientName']][hub] = {'hub':hub, 'clientPort':item['clientPort'], 'averageLatency':latency,
+                                                     'lastLatency':item['lastLatency'], 'timestamp':item['timestamp']}
+
+    output = []
+    for name in sorted(participants):
+        ranked = sorted(participants[name].values(), key=lambda hub: hub['averageLatency'])
+        output.append({'clientName':name, 'fastestHub':ranked[0]['hub'], 'hubs':ranked})
+
+    return {'hubs':hubStatus, 'participants':output}
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+#
+# load-generator.py
+#  Joins an RTP MIDI session on an input port (alsaserver.py) and sends it
+#  bursts of chords and controller sweeps as fast as it can, to see how
+#  quickly the hub gets through them. For example:
+#   ./load-generator.py 127.0.0.1 5040 1000 32 /dev/shm/midiHub-GroupOne-5040.heartbeat
+#  sends 1000 bursts of 32 packets, ten milliseconds apart. If the daemon's
+#  heartbeat file is given the number of packets it has handled is watched
+#  to see how long it takes to get through each burst. Don't do this while
+#  people are playing.
+#
+
+import sys
+import socket
+import struct
+import random
+import time
+
+ssrc = random.randint(0, 2**32-1)
+sessionName = b'load-generator'
+
+def invitation(command, token):
+    return b'\xff\xff'+command+struct.pack('>III', 2, token, ssrc)+sessionName+b'\x00'
+
+#
+# Invites the daemon on both its control port and its data port (one
+# above) and waits for it to accept.
+#
+def joinSession(host, port):
+    token = random.randint(0, 2**32-1)
+    sockets = []
+
+    for sessionPort in (port, port+1):
+        sessionSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sessionSocket.settimeout(2)
+        sessionSocket.connect((host, sessionPort))
+        sessionSocket.send(invitation(b'IN', token))
+        reply = sessionSocket.recv(1024)
+        if reply[2:4] != b'OK':
+            print(f'Invitation on port {sessionPort} not accepted: {reply[2:4]}')
+            sys.exit(1)
+        sockets.append(sessionSocket)
+
+    return sockets
+
+def leaveSession(sockets):
+    sockets[0].send(invitation(b'BY', 0))
+
+def rtpMidi(sequenceNumber, midiList):
+    header = struct.pack('>BBHII', 0x80, 0x61, sequenceNumber&0xffff, int(time.time()*10000)&0xffffffff, ssrc)
+    if len(midiList) > 15:
+        return header+bytes([0x80|(len(midiList)>>8), len(midiList)&0xff])+midiList
+    return header+bytes([len(midiList)])+midiList
+
+#
+# A burst is a chord going down, a controller sweep and the chord coming
+# back up - repeated to make up the number of packets asked for.
+#
+def makeBurst(burstSize):
+    chordOn = bytes([0x90, 60, 100, 0, 64, 100, 0, 67, 100])
+    sweep = bytes([0xb0, 1, 0]+[byte for value in range(1, 8) for byte in (0, 1, value*16)])
+    chordOff = bytes([0x80, 60, 64, 0, 64, 64, 0, 67, 64])
+
+    pattern = [chordOn, sweep, chordOff]
+    return [pattern[index%len(pattern)] for index in range(burstSize)]
+
+def readPackets(heartbeatFile):
+    with open(heartbeatFile, 'rb') as beatFile:
+        return struct.unpack('<QQQ', beatFile.read(24))[2]
+
+#
+# Waits for the daemon to have handled the given number of packets and
+# returns how long that took (or None if it never did). We sleep between
+# looks so that we don't take CPU away from the daemon we are measuring.
+#
+def waitForPackets(heartbeatFile, count, startTime):
+    deadline = startTime+1
+    while time.monotonic() < deadline:
+        if readPackets(heartbeatFile) >= count: return time.monotonic()-startTime
+        time.sleep(0.0005)
+    return None
+
+def main():
+    if len(sys.argv) < 3:
+        print(f'usage: {sys.argv[0]} host port [bursts] [packets-per-burst] [heartbeat-file] [ms-between-bursts]')
+        sys.exit(1)
+
+    host = sys.argv[1]
+    port = int(sys.argv[2])
+    bursts = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    burstSize = int(sys.argv[4]) if len(sys.argv) > 4 else 32
+    heartbeatFile = sys.argv[5] if len(sys.argv) > 5 else None
+    interval = float(sys.argv[6])/1000 if len(sys.argv) > 6 else 0.01
+
+    sockets = joinSession(host, port)
+    dataSocket = sockets[1]
+    burst = makeBurst(burstSize)
+
+    expected = readPackets(heartbeatFile) if heartbeatFile else 0
+    sequenceNumber = 0
+    sendTimes = []
+    drainTimes = []
+    lost = 0
+
+    for _ in range(bursts):
+        startTime = time.monotonic()
+        for midiList in burst:
+            dataSocket.send(rtpMidi(sequenceNumber, midiList))
+            sequenceNumber += 1
+        sendTimes.append(time.monotonic()-startTime)
+
+        if heartbeatFile:
+            expected += burstSize
+            drainTime = waitForPackets(heartbeatFile, expected, startTime)
+            if drainTime is None:
+                lost += 1
+                expected = readPackets(heartbeatFile)
+            else:
+                drainTimes.append(drainTime)
+
+        time.sleep(max(0, startTime+interval-time.monotonic()))
+
+    leaveSession(sockets)
+
+    total = bursts*burstSize
+    print(f'Sent {bursts} bursts of {burstSize} packets - {total/sum(sendTimes):.0f} packets/s while sending')
+
+    if drainTimes:
+        drainTimes.sort()
+        print(f'Daemon took {drainTimes[len(drainTimes)//2]*1000:.2f}ms (median) {drainTimes[-1]*1000:.2f}ms (max) per burst'
+              f' - {len(drainTimes)*burstSize/sum(drainTimes):.0f} packets/s')
+    if lost:
+        print(f'{lost} bursts were not completely handled (packets dropped or the daemon is too slow)')
+
+if __name__ == '__main__':
+    main()
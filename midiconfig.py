@@ -0,0 +1,184 @@
+#
+# midiconfig.py
+#  Reads the "midiports" configuration file that is shared by midihub.py and
+#  fix-stuck-notes.py and works out which groups (an input port and an output
+#  port) are needed and how they are joined to each other.
+#
+#  Groups can be listed explicitly, in which case each group's input is
+#  connected to its own output:
+#   {"GroupOne": [5040, 5042], "GroupTwo": [5050, 5052]}
+#
+#  Or just the participants can be listed:
+#   {"participants": ["Alice", "Bob", "Carol"], "basePort": 5040, "portStep": 10}
+#  Each participant gets a group of their own (Alice on 5040/5042, Bob on
+#  5050/5052, Carol on 5060/5062) and their input is connected to everyone
+#  else's output - so each participant only ever needs two ports. Ports are
+#  handed out in list order so add new people to the end. If the ports must
+#  not move when someone leaves, use a dictionary of name to input port:
+#   {"participants": {"Alice": 5040, "Bob": 5050, "Carol": 5060}}
+#
+#  The two styles can be mixed in the one file. A group can also be given as
+#  a dictionary with its ports in "ports" and other settings alongside:
+#   {"GroupOne": {"ports": [5040, 5042], "scheduling": {...}}}
+#
+#  "scheduling" (at the top level, or in a group to override it for that
+#  group) sets how the daemons are run. It has a section for each "input"
+#  (alsaserver), "output" (rtpmidi) and "background" (fix-stuck-notes) daemon:
+#   {"scheduling": {"input": {"cpus": [1], "policy": "fifo", "priority": 50, "lockMemory": true},
+#                   "output": {"cpus": [1], "policy": "fifo", "priority": 45},
+#                   "background": {"cpus": [0], "nice": 10}}}
+#  "policy" is one of other, batch, fifo or rr; "priority" applies to fifo
+#  and rr. Real time priorities and locking memory need the limits set in
+#  /etc/security/limits.d (the CloudFormation template does this).
+#
+#  "options" (again at the top level or in a group) are handed to the input
+#  daemon (alsaserver.py) for the group:
+#   {"options": {"coalesceWindow": 3}}
+#   coalesceWindow - milliseconds over which controller and pitch bend
+#                    changes are thinned out to the latest value (0 is off)
+#   transform      - channel, note, velocity and controller remapping and
+#                    filtering (see midiTransform in alsaserver.py)
+#   record         - true, or settings for recording to Standard MIDI Files
+#                    (see midiRecorder in alsaserver.py)
+#   stuckNotes     - when held notes, pedals and pitch wheels are let go of
+#                    (see peerInfo in alsaserver.py), for example
+#                    {"policy": "adaptive", "timeout": 5, "silentTimeout": 30,
+#                     "maxHold": 60, "sessionTimeout": 60}
+#   fastDecode     - false to have pymidi decode MIDI packets rather than
+#                    alsaserver's own (much faster) parser
+#   outputQueue    - true, or settings for queueing events when ALSA can't
+#                    take them - off by default (see queuedOutput in
+#                    alsaserver.py), for example
+#                    {"limit": 1024, "policy": "coalesce"}
+#
+
+import os
+import json
+
+DEFAULT_BASE_PORT = 5040
+DEFAULT_PORT_STEP = 10
+
+settingNames = ('participants', 'basePort', 'portStep', 'scheduling', 'options')
+noteRanges = {'Low':range(0, 43), 'Mid':range(43, 86), 'High':range(86, 127), 'All':range(0, 127)}
+schedulingPolicies = {'other':os.SCHED_OTHER, 'batch':os.SCHED_BATCH, 'fifo':os.SCHED_FIFO, 'rr':os.SCHED_RR}
+
+def readMidiPorts(fileName='midiports'):
+    with open(fileName) as portsFile:
+        return json.loads(portsFile.read())
+
+#
+# Returns the input port for each participant in the configuration. Each
+# participant uses two RTP MIDI listeners (the input and input+2) and each
+# of those uses two UDP ports, hence the default step of ten.
+#
+def getParticipantPorts(config):
+    participants = config.get('participants', [])
+
+    if isinstance(participants, dict):
+        return {str(name):int(participants[name]) for name in participants}
+
+    basePort = int(config.get('basePort', DEFAULT_BASE_PORT))
+    portStep = int(config.get('portStep', DEFAULT_PORT_STEP))
+    if portStep < 4: raise ValueError(f'portStep {portStep} is too small - must be at least 4')
+
+    return {str(name):basePort+(index*portStep) for index, name in enumerate(participants)}
+
+#
+# Returns the groups as a dictionary of name to [input port, output port].
+# Raises ValueError if the configuration doesn't make sense.
+#
+def getGroups(config):
+    groups = {}
+
+    for name in config:
+        if name in settingNames: continue
+
+        ports = config[name]
+        if isinstance(ports, dict): ports = ports.get('ports', [])
+        if len(ports) != 2: raise ValueError(f'Group {name} must have two ports')
+        groups[name] = [int(ports[0]), int(ports[1])]
+
+    participantPorts = getParticipantPorts(config)
+    for name in participantPorts:
+        if name in groups: raise ValueError(f'Participant {name} is also a group name')
+        groups[name] = [participantPorts[name], participantPorts[name]+2]
+
+    # Each listener uses its port for control and the next one for data
+    usedPorts = {}
+    for name in groups:
+        for port in groups[name]:
+            for udpPort in (port, port+1):
+                if udpPort in usedPorts: raise ValueError(f'Port {port} of {name} clashes with {usedPorts[udpPort]} (each listener uses its port and the next one)')
+                usedPorts[udpPort] = name
+
+    return groups
+
+#
+# Returns a list of (sender, receiver) group names - the input port of the
+# sender is connected to the output port of the receiver.
+#
+def getLinks(config):
+    links = [(name, name) for name in config if name not in settingNames]
+
+    participants = list(getParticipantPorts(config))
+    for sender in participants:
+        for receiver in participants:
+            if sender != receiver: links.append((sender, receiver))
+
+    return links
+
+#
+# Returns the scheduling settings for the given role ("input", "output" or
+# "background") with any that are specific to the group laid over the top.
+#
+def getScheduling(config, role, group=None):
+    settings = dict(config.get('scheduling', {}).get(role, {}))
+
+    if group in config and isinstance(config[group], dict):
+        settings.update(config[group].get('scheduling', {}).get(role, {}))
+
+    policy = settings.get('policy')
+    if policy and policy not in schedulingPolicies:
+        raise ValueError(f'Scheduling policy {policy} is not one of {", ".join(schedulingPolicies)}')
+
+    return settings
+
+#
+# Returns the options for the input daemon of a group, with the group's own
+# laid over the top of the global ones.
+#
+def getOptions(config, group=None):
+    options = dict(config.get('options', {}))
+
+    if group in config and isinstance(config[group], dict):
+        options.update(config[group].get('options', {}))
+
+    return options
+
+#
+# Applies CPU affinity, scheduling policy and nice value to the current
+# process. Each is tried separately; failures (usually a lack of privilege)
+# are logged and otherwise ignored - running normally is better than not
+# running at all. Memory locking doesn't survive exec() so that is left to
+# the daemon itself.
+#
+def applyScheduling(settings, logger):
+    if 'cpus' in settings:
+        try:
+            os.sched_setaffinity(0, [int(cpu) for cpu in settings['cpus']])
+        except Exception as e:
+            logger.warning(f'Cannot set CPU affinity to {settings["cpus"]}: {e}')
+
+    if 'policy' in settings:
+        policy = schedulingPolicies[settings['policy']]
+        priority = int(settings.get('priority', 1)) if policy in (os.SCHED_FIFO, os.SCHED_RR) else 0
+        try:
+            os.sched_setscheduler(0, policy, os.sched_param(priority))
+        except Exception as e:
+            logger.warning(f'Cannot set scheduling policy {settings["policy"]} priority {priority}: {e}')
+
+    if 'nice' in settings:
+        try:
+            os.nice(int(settings['nice']))
+        except Exception as e:
+            logger.warning(f'Cannot set nice value {settings["nice"]}: {e}')
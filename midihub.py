@@ -5,11 +5,22 @@ import os
 import logging
 import signal
 import time
+import select
+import errno
+import asyncio
+import threading
+import urllib.parse
+import http
+import struct
+import datetime
+import shutil
 import subprocess
 import boto3
-import requests
 import json
 import alsa_midi
+from alsa_midi.client import SequencerClientBase
+import midiconfig
+import midiprofile
 
 #
 # Configuration:
@@ -20,19 +31,131 @@ import alsa_midi
 #  MIDI_DAEMON:
 #      Path to the RTP MIDI daemon.
 #
-#  midiPorts:
-#      List of ports to open to listen to MIDI connections. Each port will
+#  midiConfig:
+#      Groups of ports to open to listen to MIDI connections. Each port will
 #      be opened as a separate process using the RTP MIDI daemon.
 #      These can also be configured by creating a file in the running
-#      directory called "midiports". Put a comma-seperate list of ports into
-#      the file and it will be read during startup or if SIGHUP is sent.
+#      directory called "midiports". Put the groups (or a list of
+#      participants - see midiconfig.py) into the file as JSON and it will be
+#      read during startup or if SIGHUP is sent.
+#
+#  READ_DAEMON_LOGS / LOG_READ_INTERVAL:
+#      Each daemon writes to its own log file (../output-{port}.log). When
+#      READ_DAEMON_LOGS is True this script follows the output daemons' logs,
+#      looking every LOG_READ_INTERVAL seconds, and picks up the latency
+#      ("rtt") lines as they are written, so there is no need for the cron
+#      job that greps the log files into update-latency.py. The daemons don't
+#      depend on us for their logging so they carry on just the same if this
+#      script stops or is restarted; it starts following again from the end
+#      of each file. The logs are also rotated at LOG_MAX_BYTES, keeping
+#      LOG_BACKUP_COUNT old files.
+#  LATENCY_UPDATE_INTERVAL:
+#      How often (in seconds) the latency figures for clients that have
+#      changed are written to DynamoDB when READ_DAEMON_LOGS is True.
+#  HTTP_API_PORT:
+#      If not zero, a small HTTP service is run on this TCP port which
+#      answers /latency, /getTransmitPorts and /resetStuckNote the same way
+#      that the Lambda functions behind API Gateway do - but from memory and
+#      without going through DynamoDB or SQS. It also serves latency.html and
+#      fixstucknotes.html pointing at itself, and /latencyStream which pushes
+#      (as server-sent events) each client's latency as soon as it changes.
+#      Remember to allow the port in the security group.
+#  STREAM_KEEPALIVE_INTERVAL:
+#      How often (in seconds) to send something on an idle /latencyStream so
+#      that proxies and browsers don't give up on it.
+#  WATCHDOG_TIMEOUT:
+#      If an input daemon's heartbeat (written to HEARTBEAT_DIRECTORY) is
+#      older than this many seconds it is treated as hung and restarted.
+#      Zero turns the watchdog off.
+#  OUTPUT_PROBE / PROBE_FAILURES:
+#      Whether the watchdog also checks that the output daemons are taking
+#      events from ALSA, and how many failed checks in a row mean one is hung.
+#  RESET_TIMEOUT:
+#      How long (in seconds) a reset keeps trying to get its NoteOffs to an
+#      output daemon that isn't taking them before giving up.
+#  DAEMON_STOP_TIMEOUT:
+#      When a group is removed from "midiports" (and SIGHUP is sent) how long
+#      to wait for each of its daemons to stop before killing it outright.
+#  STARTUP_POLL_INTERVAL / STARTUP_TIMEOUT:
+#      Daemons that have just been started are connected up as soon as they
+#      are ready instead of on the next check. Input daemons say when they
+#      are ready; output daemons are looked for every STARTUP_POLL_INTERVAL
+#      seconds. After STARTUP_TIMEOUT seconds we stop waiting and leave it to
+#      the regular checks.
 #
 SLEEP_CHECK_INTERVAL = 3
 MIDI_INPUT_DAEMON = '/home/ubuntu/pymidi/alsaserver.py'
 MIDI_OUTPUT_DAEMON = '/opt/rtpmidi_1.1.2-ubuntu22.04/bin/rtpmidi'
+READ_DAEMON_LOGS = True
+LOG_READ_INTERVAL = 0.5
+LOG_MAX_BYTES = 5*1024*1024
+LOG_BACKUP_COUNT = 3
+LATENCY_UPDATE_INTERVAL = 10
+DAEMON_STOP_TIMEOUT = 2
+WATCHDOG_TIMEOUT = 5
+HEARTBEAT_DIRECTORY = '/dev/shm'
+OUTPUT_PROBE = True
+PROBE_FAILURES = 3
+RESET_TIMEOUT = 1
+HTTP_API_PORT = 0
+STREAM_KEEPALIVE_INTERVAL = 15
+STARTUP_POLL_INTERVAL = 0.05
+STARTUP_TIMEOUT = 10
 
-midiPorts = {'GroupOne': [5040, 5042], 'GroupTwo': [5050, 5052]}
+midiConfig = {'GroupOne': [5040, 5042], 'GroupTwo': [5050, 5052]}
+midiPorts = {}
+midiLinks = []
 logger = None
+daemonLogs = {}
+latencyStats = {}
+latencyLock = threading.Lock() # recordLatency() runs in the log reader thread
+latencyTable = None
+lastLatencyUpdate = 0
+reconfigureRequested = False
+hubClient = None
+hubPort = None
+hubLock = threading.Lock()
+probeFailures = {}
+httpLoop = None
+latencyListeners = set()
+startingDaemons = {}
+readyPipes = {}
+readyPorts = set()
+
+#
+# Follows an output daemon's log file, recording any latency lines as they
+# are written. We start from the beginning of the file so that a restarted
+# midihub.py rebuilds the same figures that it saved before (rotation keeps
+# the file to LOG_MAX_BYTES). If the file gets shorter it has been rotated
+# and we start again from the beginning.
+#
+class daemonLog():
+    def __init__(self, port):
+        self.port = port
+        self.fileName = f'../output-{port}.log'
+        self.buffer = b''
+        self.offset = 0
+
+    def read(self):
+        try:
+            with open(self.fileName, 'rb') as logFile:
+                size = os.fstat(logFile.fileno()).st_size
+                if size < self.offset:
+                    self.offset = 0
+                    self.buffer = b''
+                if size == self.offset: return
+
+                logFile.seek(self.offset)
+                data = logFile.read(size-self.offset)
+        except FileNotFoundError:
+            self.offset = 0
+            return
+
+        self.offset += len(data)
+        lines = (self.buffer+data).split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            if b'rtt: ' in line: recordLatency(self.port, line.decode('utf-8', errors='replace'))
 
 #
 # Main loop which does a few startup checks and runs forever.
@@ -45,12 +168,24 @@ def main():
     global logger
 
     signal.signal(signal.SIGINT, interrupted)
-    signal.signal(signal.SIGHUP, configure)
+    signal.signal(signal.SIGHUP, hangup)
 
     logging.basicConfig()
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
 
+    if len(sys.argv) > 1 and sys.argv[1] == 'instructions':
+        logger.setLevel(logging.WARNING)
+        configure('', '')
+        print('\n'.join(connectionInstructions()))
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        logger.setLevel(logging.WARNING)
+        configure('', '')
+        printStatus()
+        sys.exit(0)
+
     if alreadyRunning():
         logger.debug('This is the second copy - stopping')
         sys.exit(0)
@@ -60,12 +195,33 @@ def main():
     if not checkPrerequisites():
         sys.exit(1)
 
+    if HTTP_API_PORT: startHttpApi()
+    if READ_DAEMON_LOGS: startLogReader()
+    midiprofile.install('midihub', logger)
+
     logger.info('Entering main loop')
     while True:
+        if reconfigureRequested: reconfigure()
+
+        started = midiprofile.start()
         checkDaemon()
+        if started: midiprofile.record('checkDaemon', started)
+
+        started = midiprofile.start()
+        checkLiveness()
+        if started: midiprofile.record('checkLiveness', started)
+
+        started = midiprofile.start()
         checkMidiParticipants()
+        if started: midiprofile.record('checkMidiParticipants', started)
+
+        waitForStartup()
 
-        time.sleep(SLEEP_CHECK_INTERVAL)
+        waitForReady(SLEEP_CHECK_INTERVAL)
+        if time.time()-lastLatencyUpdate >= LATENCY_UPDATE_INTERVAL:
+            started = midiprofile.start()
+            updateLatency()
+            if started: midiprofile.record('updateLatency', started)
 
 #
 # See if we have daemons running on the ports specified in the global
@@ -73,29 +229,33 @@ def main():
 # the daemon and the port number then we fork() and create one.
 #
 def checkDaemon():
-    global logger, midiPorts
+    global logger, midiPorts, startingDaemons, readyPipes, readyPorts
+
+    try: # Tidy up after any daemons that have exited
+        while os.waitpid(-1, os.WNOHANG)[0] > 0: pass
+    except ChildProcessError:
+        pass
 
-    midiStatus = {}
+    midiStatus = findDaemons(midiPorts)
     inputDaemonName = os.path.basename(MIDI_INPUT_DAEMON)
     outputDaemonName = os.path.basename(MIDI_OUTPUT_DAEMON)
 
-    stream = os.popen('/usr/bin/ps -ef')
-    psLine = stream.readline()
-    while psLine:
-        if psLine.find(inputDaemonName) > -1 or psLine.find(outputDaemonName) > -1:
-            for group in midiPorts:
-                for port in midiPorts[group]:
-                    if psLine.find(str(port)) > -1:
-                        midiStatus[port] = True
-                        break
-        psLine = stream.readline()
-
     for group in midiPorts:
         for port in midiPorts[group]:
             if port in midiStatus: continue
 
-            logger.warning(f'Midi daemon {group}-{port} not running - starting')
-            if os.fork() == 0: # We are the child process
+            role = 'input' if port == midiPorts[group][0] else 'output'
+            scheduling = midiconfig.getScheduling(midiConfig, role, group)
+
+            logger.warning(f'Midi daemon {group}-{port} not running - starting' + (f' with {scheduling}' if scheduling else ''))
+            if role == 'input':
+                readyRead, readyWrite = os.pipe()
+
+            started = time.time()
+            readyPorts.discard(port)
+
+            pid = os.fork()
+            if pid == 0: # We are the child process
                 name = f'midiHub-{group}-{port}';
 
                 newStdErr = os.open(f'../output-{port}.log', os.O_WRONLY|os.O_CREAT|os.O_APPEND)
@@ -103,23 +263,744 @@ def checkDaemon():
                 os.close(newStdErr)
                 os.close(1) # Close STDOUT
 
-                if port == midiPorts[group][0]: # Input port
+                midiconfig.applyScheduling(scheduling, logger)
+
+                if role == 'input':
+                    options = midiconfig.getOptions(midiConfig, group)
+                    options['lockMemory'] = scheduling.get('lockMemory', False)
+                    if WATCHDOG_TIMEOUT: options['heartbeatDirectory'] = HEARTBEAT_DIRECTORY
+                    os.close(readyRead)
+                    os.set_inheritable(readyWrite, True)
+                    options['readyFd'] = readyWrite
+                    os.environ['MIDIHUB_OPTIONS'] = json.dumps(options)
                     os.execlp(MIDI_INPUT_DAEMON, inputDaemonName, str(port), name)
                 else:
                     os.execlp(MIDI_OUTPUT_DAEMON, outputDaemonName, f'multilisten', '-u', str(port), '-C', name, '-P', name)
 
+            startingDaemons[port] = (group, role, started, pid)
+            if role == 'input':
+                os.close(readyWrite)
+                os.set_blocking(readyRead, False)
+                readyPipes[readyRead] = port
+
+#
+# Prints each daemon with its process id and how it is actually being
+# scheduled, which may not be what was asked for if we weren't allowed.
+#
+def printStatus():
+    global midiPorts
+
+    policyNames = {value:name for name, value in midiconfig.schedulingPolicies.items()}
+    daemons = findDaemons(midiPorts)
+
+    for group in midiPorts:
+        for port in midiPorts[group]:
+            pid = daemons.get(port)
+            if not pid:
+                print(f'{group}-{port}: not running')
+                continue
+
+            try:
+                policy = policyNames.get(os.sched_getscheduler(pid), 'unknown')
+                priority = os.sched_getparam(pid).sched_priority
+                cpus = sorted(os.sched_getaffinity(pid))
+                nice = os.getpriority(os.PRIO_PROCESS, pid)
+
+                lockedMemory = 'unknown'
+                with open(f'/proc/{pid}/status') as statusFile:
+                    for line in statusFile:
+                        if line.startswith('VmLck:'): lockedMemory = line.split(':')[1].strip()
+            except Exception as e:
+                print(f'{group}-{port}: pid {pid} - cannot get scheduling: {e}')
+                continue
+
+            health = ''
+            heartbeat = readHeartbeat(f'midiHub-{group}-{port}')
+            if heartbeat and heartbeat[0] == pid:
+                health = f' heartbeat {time.time()-heartbeat[1]:.1f}s ago packets {heartbeat[2]} output overflows {heartbeat[3]}'
+
+            print(f'{group}-{port}: pid {pid} policy {policy} priority {priority} nice {nice} cpus {cpus} locked {lockedMemory}{health}')
+
+#
+# Look through the process list for daemons that belong to the groups given.
+# Each daemon has its ALSA name (midiHub-group-port) on its command line so
+# we can tell exactly which group it belongs to. Returns the process id of
+# each daemon found keyed by port number.
+#
+def findDaemons(groups):
+    daemons = {}
+    inputDaemonName = os.path.basename(MIDI_INPUT_DAEMON)
+    outputDaemonName = os.path.basename(MIDI_OUTPUT_DAEMON)
+
+    stream = os.popen('/usr/bin/ps -eo pid,args')
+    for psLine in stream:
+        if psLine.find(inputDaemonName) == -1 and psLine.find(outputDaemonName) == -1: continue
+
+        psLine = psLine.strip()+' '
+        for group in groups:
+            for port in groups[group]:
+                if psLine.find(f'midiHub-{group}-{port} ') > -1:
+                    daemons[port] = int(psLine.split()[0])
+
+    return daemons
+
+#
+# Called from the main loop after SIGHUP. Rather than starting over we work
+# out which groups have changed: groups that have gone (or whose ports have
+# changed) are stopped and new ones are left for checkDaemon() to start.
+# Daemons whose options or scheduling have changed are stopped too so that
+# checkDaemon() starts them again with the new ones - options only matter
+# to the input daemon. Groups that are the same keep their daemons and ALSA
+# connections so that anyone playing through them doesn't notice a thing.
+#
+def reconfigure():
+    global logger, midiConfig, midiPorts, reconfigureRequested
+
+    reconfigureRequested = False
+
+    oldConfig = midiConfig
+    oldPorts = midiPorts
+    configure('', '')
+
+    removedGroups = [group for group in oldPorts if midiPorts.get(group) != oldPorts[group]]
+    addedGroups = [group for group in midiPorts if oldPorts.get(group) != midiPorts[group]]
+
+    restartPorts = {}
+    for group in midiPorts:
+        if group in addedGroups: continue
+
+        inputPort, outputPort = midiPorts[group]
+        if midiconfig.getOptions(oldConfig, group) != midiconfig.getOptions(midiConfig, group) or \
+           midiconfig.getScheduling(oldConfig, 'input', group) != midiconfig.getScheduling(midiConfig, 'input', group):
+            restartPorts.setdefault(group, []).append(inputPort)
+        if midiconfig.getScheduling(oldConfig, 'output', group) != midiconfig.getScheduling(midiConfig, 'output', group):
+            restartPorts.setdefault(group, []).append(outputPort)
+
+    if not removedGroups and not addedGroups and not restartPorts:
+        logger.info('Configuration unchanged')
+        return
+
+    logger.info(f'Reconfiguring - adding {addedGroups} removing {removedGroups} restarting {restartPorts}')
+
+    for group in removedGroups:
+        restartPorts[group] = oldPorts[group]
+
+    daemons = findDaemons(restartPorts)
+    for group in restartPorts:
+        for port in restartPorts[group]: # Input first so its NoteOffs reach the output
+            if port in daemons: stopDaemon(f'{group}-{port}', daemons[port])
+
+#
+# Ask a daemon to stop (alsaserver releases any held notes when it gets
+# SIGTERM) and wait for it to go. If it's still there after a while it is
+# killed.
+#
+def stopDaemon(name, pid):
+    global logger
+
+    logger.info(f'Stopping midi daemon {name} (pid {pid})')
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+
+    endTime = time.time()+DAEMON_STOP_TIMEOUT
+    while time.time() < endTime:
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid: return
+        except ChildProcessError: # Not one of ours (we were restarted) so just look for it
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                return
+        time.sleep(0.1)
+
+    logger.warning(f'Midi daemon {name} did not stop - killing')
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except (ProcessLookupError, ChildProcessError):
+        pass
+
+#
+# Instead of sleeping between checks we wait on the pipes that input
+# daemons use to say they're ready and return as soon as one does so that
+# it can be connected up.
+#
+def waitForReady(timeout):
+    global readyPipes
+
+    endTime = time.time()+timeout
+    while True:
+        remaining = endTime-time.time()
+        if remaining <= 0: return
+
+        if not readyPipes:
+            time.sleep(remaining)
+            return
+
+        readable, _, _ = select.select(list(readyPipes), [], [], remaining)
+        for fd in readable:
+            readReady(fd)
+            endTime = 0
+
+#
+# The daemons' logs are looked after in a thread of their own so that the
+# latency lines are picked up as soon as they are written, whatever the
+# main loop is waiting for.
+#
+def readDaemonLogs():
+    global logger, midiPorts, daemonLogs
+
+    while True:
+        try:
+            groupPorts = list(midiPorts.values())
+            outputPorts = {ports[1] for ports in groupPorts}
+
+            for port in outputPorts:
+                if port not in daemonLogs: daemonLogs[port] = daemonLog(port)
+                daemonLogs[port].read()
+            for port in list(daemonLogs):
+                if port not in outputPorts: del daemonLogs[port]
+
+            for ports in groupPorts:
+                for port in ports: rotateLog(f'../output-{port}.log')
+        except Exception as e:
+            logger.warning(f'Cannot read daemon logs: {e}')
+
+        time.sleep(LOG_READ_INTERVAL)
+
+#
+# The daemons keep their log files open, so rather than renaming a file
+# that has grown past LOG_MAX_BYTES (they would carry on writing to it) we
+# copy it to .1, moving the older copies along, and empty it. Anything
+# written between the two is lost.
+#
+def rotateLog(fileName):
+    try:
+        if os.path.getsize(fileName) < LOG_MAX_BYTES: return
+    except FileNotFoundError:
+        return
+
+    for index in range(LOG_BACKUP_COUNT-1, 0, -1):
+        if os.path.exists(f'{fileName}.{index}'): os.replace(f'{fileName}.{index}', f'{fileName}.{index+1}')
+    if LOG_BACKUP_COUNT: shutil.copyfile(fileName, f'{fileName}.1')
+    os.truncate(fileName, 0)
+
+def startLogReader():
+    threading.Thread(target=readDaemonLogs, daemon=True).start()
+
+#
+# An input daemon writes to its ready pipe once it is listening and has its
+# ALSA port, then closes it. If it closes it without writing anything it
+# stopped before it got that far.
+#
+def readReady(fd):
+    global logger, readyPipes, readyPorts, startingDaemons
+
+    try:
+        data = os.read(fd, 64)
+    except BlockingIOError:
+        return
+
+    port = readyPipes.pop(fd)
+    os.close(fd)
+
+    if data:
+        logger.info(f'Midi daemon on port {port} is ready')
+        readyPorts.add(port)
+    else:
+        logger.warning(f'Midi daemon on port {port} stopped before it was ready')
+        startingDaemons.pop(port, None) # Nothing to wait for
+
+#
+# Daemons that checkDaemon() has just started are connected up the moment
+# both halves of their group are ready rather than on the next pass of the
+# main loop. Input daemons tell us (see readReady()); for output daemons
+# (which can't) we look for their ALSA port every STARTUP_POLL_INTERVAL
+# seconds. Anything that has exited, or isn't ready after STARTUP_TIMEOUT
+# seconds, is left for the regular checks.
+#
+def waitForStartup():
+    global logger, midiPorts, startingDaemons, readyPorts
+
+    if not startingDaemons: return
+
+    alsaClient = alsa_midi.SequencerClient('midiHubStartup')
+    try:
+        while startingDaemons:
+            waitForReady(STARTUP_POLL_INTERVAL)
+
+            clientNames = {client.name for client in alsaClient.list_ports()}
+            now = time.time()
+            readyGroups = set()
+
+            for port in list(startingDaemons):
+                group, role, started, pid = startingDaemons[port]
+                if role == 'input':
+                    ready = port in readyPorts
+                else:
+                    ready = f'midiHub-{group}-{port}' in clientNames
+
+                if port not in midiPorts.get(group, []):
+                    del startingDaemons[port]
+                elif ready:
+                    logger.info(f'Midi daemon {group}-{port} started in {now-started:.2f}s')
+                    del startingDaemons[port]
+                    readyPorts.discard(port)
+                    readyGroups.add(group)
+                elif role == 'output' and daemonExited(pid): # Input daemons close their pipe
+                    logger.warning(f'Midi daemon {group}-{port} stopped before it was ready')
+                    del startingDaemons[port]
+                elif now-started > STARTUP_TIMEOUT:
+                    logger.warning(f'Midi daemon {group}-{port} not ready after {STARTUP_TIMEOUT}s - no longer waiting')
+                    del startingDaemons[port]
+
+            waitingGroups = {group for group, role, started, pid in startingDaemons.values()}
+            if readyGroups-waitingGroups: checkMidiParticipants()
+    finally:
+        alsaClient.close()
+
+def daemonExited(pid):
+    try:
+        return os.waitpid(pid, os.WNOHANG)[0] != 0
+    except ChildProcessError: # Already tidied up by checkDaemon()
+        return True
+
+#
+# Lines from rtpmidi that we care about look something like:
+#  2023-09-01 10:11:12.123 ... ] [ClientName] ... rtt: 0.0123
+# We keep a running total for each client/port so that the average, minimum,
+# maximum and last values are always up to date without re-reading anything.
+#
+def recordLatency(port, line):
+    global logger, latencyStats
+
+    latencyMarker = line.find('rtt: ')
+    clientMarker = line.find('] [')
+    if latencyMarker == -1 or clientMarker == -1: return
+
+    try:
+        latencyValue = round(float(line[latencyMarker+5:])*1000, 1)
+
+        endClientMarker = line.find(']', clientMarker+3)
+        clientName = line[clientMarker+3:endClientMarker].strip()
+
+        epochTime = int(datetime.datetime.strptime(line[:19], '%Y-%m-%d %H:%M:%S').timestamp())
+    except Exception as e:
+        logger.warning(f'Failed to parse latency from port {port}: {e}')
+        return
+
+    id = f'{clientName}-{port}'
+    with latencyLock:
+        if id not in latencyStats:
+            latencyStats[id] = {'count':0, 'total':0.0, 'max':(epochTime, latencyValue), 'min':(epochTime, latencyValue)}
+
+        stats = latencyStats[id]
+        stats['count'] += 1
+        stats['total'] += latencyValue
+        if latencyValue > stats['max'][1]: stats['max'] = (epochTime, latencyValue)
+        if latencyValue < stats['min'][1]: stats['min'] = (epochTime, latencyValue)
+        stats['last'] = (epochTime, latencyValue)
+        stats['changed'] = True
+
+    if httpLoop and latencyListeners:
+        httpLoop.call_soon_threadsafe(pushLatency, id)
+
+#
+# Writes the clients that have had new latency samples since the last time
+# we were called into DynamoDB in one batch. The items are the same as the
+# ones update-latency.py writes so the latency Lambda doesn't care which
+# one of us did it.
+#
+def updateLatency():
+    global logger, latencyStats, latencyTable, lastLatencyUpdate
+
+    lastLatencyUpdate = time.time()
+
+    if not any(stats.get('changed') for stats in list(latencyStats.values())): return
+
+    if latencyTable is None: latencyTable = getLatencyTable()
+    if not latencyTable: return
+
+    with latencyLock:
+        changed = {id:dict(latencyStats[id]) for id in latencyStats if latencyStats[id].get('changed')}
+        for id in changed: latencyStats[id]['changed'] = False
+
+    now = int(lastLatencyUpdate)
+    expiry = now+(86400*7) # Expire this record in seven days
+
+    try:
+        with latencyTable.batch_writer() as batch:
+            for id in changed:
+                stats = changed[id]
+                average = round(stats['total']/stats['count'], 1)
+
+                # Floats are stored as strings because DynamoDB doesn't
+                # support float types here
+                item = {'clientId':id, 'timestamp':now, 'expiryTime':expiry,
+                        'lastLatency':str(stats['last'][1]), 'lastLatencyTime':stats['last'][0],
+                        'maxLatency':str(stats['max'][1]), 'maxLatencyTime':stats['max'][0],
+                        'minLatency':str(stats['min'][1]), 'minLatencyTime':stats['min'][0],
+                        'averageLatency':str(average)}
+                batch.put_item(Item=item)
+    except Exception as e:
+        logger.warning(f'Failed to save latency to DynamoDB - will retry: {e}')
+        with latencyLock:
+            for id in changed: latencyStats[id]['changed'] = True
+
+#
+# The HTTP service runs in its own thread with its own asyncio loop so that
+# the main loop carries on exactly as before. It only reads what the main
+# loop keeps in memory; resets go straight to the output daemon via ALSA.
+#
+def startHttpApi():
+    global logger
+
+    logger.info(f'Starting HTTP service on port {HTTP_API_PORT}')
+    threading.Thread(target=asyncio.run, args=(serveHttpApi(),), daemon=True).start()
+
+async def serveHttpApi():
+    global httpLoop
+
+    httpLoop = asyncio.get_running_loop()
+    server = await asyncio.start_server(handleHttpRequest, '0.0.0.0', HTTP_API_PORT)
+    async with server:
+        await server.serve_forever()
+
+#
+# Just enough HTTP/1.1 for a browser or curl: one GET per connection.
+#
+async def handleHttpRequest(reader, writer):
+    global logger
+
+    try:
+        requestLine = await asyncio.wait_for(reader.readline(), 10)
+        while True: # We don't need any of the headers
+            header = await asyncio.wait_for(reader.readline(), 10)
+            if header in (b'\r\n', b'\n', b''): break
+
+        method, target = requestLine.decode('ascii').split()[:2]
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+
+        if method == 'GET' and url.path == '/latencyStream':
+            await streamLatency(writer)
+            return
+
+        status, contentType, body = await httpRoute(method, url.path, query)
+    except Exception as e:
+        logger.warning(f'Bad HTTP request: {e}')
+        status, contentType, body = (400, 'text/plain', 'Bad request')
+
+    body = body.encode('utf-8')
+    headers = (f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+               f'Content-Type: {contentType}\r\n'
+               f'Content-Length: {len(body)}\r\n'
+               'Access-Control-Allow-Origin: *\r\n'
+               'Connection: close\r\n\r\n')
+    try:
+        writer.write(headers.encode('ascii')+body)
+        await writer.drain()
+        writer.close()
+    except Exception as e:
+        logger.warning(f'Failed to send HTTP response: {e}')
+
+#
+# Server-sent events: everything we know to start with and then only the
+# clients whose figures have changed, as they change. Each event is one
+# row in the same shape as the items from /latency.
+#
+async def streamLatency(writer):
+    global logger, latencyStats, latencyLock, latencyListeners
+
+    queue = asyncio.Queue()
+    latencyListeners.add(queue)
+
+    try:
+        writer.write(('HTTP/1.1 200 OK\r\n'
+                      'Content-Type: text/event-stream\r\n'
+                      'Cache-Control: no-cache\r\n'
+                      'Access-Control-Allow-Origin: *\r\n\r\n').encode('ascii'))
+
+        for item in getLatencyList():
+            writer.write(f'data: {json.dumps(item)}\n\n'.encode('utf-8'))
+        await writer.drain()
+
+        while True:
+            try:
+                id = await asyncio.wait_for(queue.get(), STREAM_KEEPALIVE_INTERVAL)
+                with latencyLock:
+                    stats = dict(latencyStats[id])
+                writer.write(f'data: {json.dumps(latencyItem(id, stats))}\n\n'.encode('utf-8'))
+            except asyncio.TimeoutError:
+                writer.write(b': keepalive\n\n')
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError): # The browser has gone away
+        pass
+    except Exception as e:
+        logger.error(f'Latency stream stopped: {e}')
+    finally:
+        latencyListeners.discard(queue)
+        writer.close()
+
+#
+# Called in the HTTP thread (via call_soon_threadsafe) when a client's
+# latency changes.
+#
+def pushLatency(id):
+    global latencyListeners
+
+    for queue in latencyListeners:
+        queue.put_nowait(id)
+
+#
+# Returns (status, content type, body) for a request. The JSON is the same
+# shape that the Lambda functions return so the web pages work with either.
+# A reset can wait for hubLock and for a slow daemon so it is done in a
+# worker thread rather than holding up every other request.
+#
+async def httpRoute(method, path, query):
+    global logger, midiPorts
+
+    if method != 'GET': return (405, 'text/plain', 'Only GET is supported')
+
+    if path == '/latency':
+        return (200, 'application/json', json.dumps(getLatencyList()))
+
+    if path == '/getTransmitPorts':
+        return (200, 'application/json', json.dumps([midiPorts[group][1] for group in midiPorts]))
+
+    if path == '/resetStuckNote':
+        portNumber = query.get('port', '')
+        noteRange = query.get('range', '')
+
+        if not portNumber: return (400, 'text/plain', 'Specify port')
+        if not noteRange: return (400, 'text/plain', 'Specify range')
+
+        try:
+            await asyncio.to_thread(resetStuckNotes, int(portNumber), noteRange)
+        except Exception as e:
+            logger.error(f'Reset failed: {e}')
+            return (500, 'text/plain', f'Reset failed: {e}')
+
+        return (200, 'application/json', 'null')
+
+    if path in ('/latency.html', '/fixstucknotes.html'):
+        with open(path[1:]) as htmlFile: # Point the page back at us
+            return (200, 'text/html', htmlFile.read().replace('--APIGATEWAYENDPOINT--', ''))
+
+    return (404, 'text/plain', 'Not found')
+
+#
+# Same as lambda-midiHubStats.py but from the figures in memory.
+#
+def getLatencyList():
+    global latencyStats, latencyLock
+
+    with latencyLock: # recordLatency() fills entries in from another thread
+        snapshot = {id:dict(stats) for id, stats in latencyStats.items()}
+
+    return [latencyItem(id, stats) for id, stats in snapshot.items()]
+
+def latencyItem(id, stats):
+    hyphen = id.rfind('-')
+
+    return {'clientName':id[:hyphen], 'clientPort':id[hyphen+1:], 'timestamp':str(stats['last'][0]),
+            'averageLatency':str(round(stats['total']/stats['count'], 1)), 'maxLatency':str(stats['max'][1]),
+            'minLatency':str(stats['min'][1]), 'lastLatency':str(stats['last'][1]),
+            'maxLatencyTime':str(stats['max'][0]), 'minLatencyTime':str(stats['min'][0]),
+            'lastLatencyTime':str(stats['last'][0])}
+
+#
+# Does what fix-stuck-notes.py does when it gets a message from SQS: sends
+# NoteOff for a range of notes on all channels to one of the transmit ports.
+# Events are addressed to the port directly so no connection is needed.
+#
+def resetStuckNotes(portNumber, noteRange):
+    global logger, midiPorts, hubClient, hubPort
+
+    transmitPorts = {midiPorts[group][1]:f'midiHub-{group}-{midiPorts[group][1]}' for group in midiPorts}
+    if portNumber not in transmitPorts: raise ValueError(f'Port {portNumber} is not defined')
+
+    if noteRange not in midiconfig.noteRanges:
+        logger.warning(f'Range {noteRange} not specified - using All')
+        noteRange = 'All'
+
+    with hubLock: # Called from the main loop (watchdog) and the HTTP thread
+        destination = findHubPort(transmitPorts[portNumber])
+        if not destination: raise ValueError(f'Did not find destination for port {portNumber}')
+
+        logger.info(f'Sending NoteOff to {portNumber} for {midiconfig.noteRanges[noteRange]}')
+        events = [alsa_midi.NoteOffEvent(note=midiNote, velocity=64, channel=chan)
+                  for midiNote in midiconfig.noteRanges[noteRange] for chan in range(16)]
+        if not sendWithoutWaiting(events, destination, RESET_TIMEOUT):
+            raise Exception(f'Port {portNumber} is not taking events')
+
+#
+# Sends events to one of our daemons' ports. SequencerClient's own output
+# calls wait (with no timeout) while the kernel's buffer for the port is
+# full - which is just what happens when the daemon has stopped reading -
+# so we go through SequencerClientBase's, which give up with -EAGAIN.
+# Keeps trying for up to timeout seconds; returns False (and throws away
+# whatever hasn't gone) if that isn't long enough. Call with hubLock held.
+#
+def sendWithoutWaiting(events, destination, timeout=0):
+    endTime = time.time()+timeout
+    sent = 0
+
+    while True:
+        try:
+            while sent < len(events):
+                SequencerClientBase.event_output_buffer(hubClient, events[sent], port=hubPort, dest=destination)
+                sent += 1
+            SequencerClientBase.drain_output(hubClient)
+            return True
+        except alsa_midi.ALSAError as e:
+            if e.errnum != -errno.EAGAIN or time.time() >= endTime:
+                hubClient.drop_output_buffer()
+                if e.errnum != -errno.EAGAIN: raise
+                return False
+
+        time.sleep(0.01)
+
+#
+# Finds one of our daemons' ALSA ports by name using the client we send
+# resets and probes from (which is created the first time it's needed).
+# Call with hubLock held.
+#
+def findHubPort(name):
+    global hubClient, hubPort
+
+    if not hubClient:
+        hubClient = alsa_midi.SequencerClient('midiHubReset')
+        hubPort = hubClient.create_port('reset')
+
+    for client in hubClient.list_ports():
+        if client.name == name: return client
+
+    return None
+
+#
+# A daemon can be running but stuck - in which case it looks fine to
+# checkDaemon(). Each alsaserver writes a heartbeat (its process id, the
+# time and how many packets it has handled) to a small file in
+# HEARTBEAT_DIRECTORY every time around its loop. If that stops for
+# WATCHDOG_TIMEOUT seconds the daemon is stopped, everyone it was sending to
+# gets NoteOff for everything (we can't know what it was holding) and
+# checkDaemon() starts it again.
+# We can't see inside rtpmidi so instead we send an ALSA echo event to its
+# port without waiting (see sendWithoutWaiting). If it isn't reading its
+# events the kernel refuses the event; after PROBE_FAILURES refusals in a
+# row it's restarted.
+#
+def checkLiveness():
+    global logger, midiPorts, midiLinks, probeFailures
+
+    if not WATCHDOG_TIMEOUT: return
+
+    daemons = findDaemons(midiPorts)
+    now = time.time()
+
+    for group in midiPorts:
+        inputPort, outputPort = midiPorts[group]
+
+        pid = daemons.get(inputPort)
+        heartbeat = readHeartbeat(f'midiHub-{group}-{inputPort}')
+        if pid and heartbeat and heartbeat[0] == pid and now-heartbeat[1] > WATCHDOG_TIMEOUT:
+            logger.warning(f'Midi daemon {group}-{inputPort} stalled - no heartbeat for {now-heartbeat[1]:.1f}s after {heartbeat[2]} packets - restarting')
+            stopDaemon(f'{group}-{inputPort}', pid)
+            for sender, receiver in midiLinks:
+                if sender != group: continue
+                try:
+                    resetStuckNotes(midiPorts[receiver][1], 'All')
+                except Exception as e:
+                    logger.warning(f'Cannot reset notes for {receiver}: {e}')
+
+        pid = daemons.get(outputPort)
+        if not OUTPUT_PROBE or not pid: continue
+
+        if probeDaemon(f'midiHub-{group}-{outputPort}'):
+            probeFailures[outputPort] = 0
+            continue
+
+        probeFailures[outputPort] = probeFailures.get(outputPort, 0)+1
+        if probeFailures[outputPort] >= PROBE_FAILURES:
+            logger.warning(f'Midi daemon {group}-{outputPort} not taking events from ALSA - restarting')
+            stopDaemon(f'{group}-{outputPort}', pid)
+            probeFailures[outputPort] = 0
+
+#
+# Returns (process id, time, packet count, output overflows) from a daemon's
+# heartbeat or None if there isn't one (yet). Daemons from before the
+# overflow count was added don't have it.
+#
+def readHeartbeat(name):
+    try:
+        with open(f'{HEARTBEAT_DIRECTORY}/{name}.heartbeat', 'rb') as heartbeatFile:
+            data = heartbeatFile.read(32)
+        pid, milliseconds, packets = struct.unpack('<QQQ', data[:24])
+        overflows = struct.unpack('<Q', data[24:32])[0] if len(data) >= 32 else 0
+    except Exception:
+        return None
+
+    return (pid, milliseconds/1000, packets, overflows)
+
+def probeDaemon(name):
+    global logger, hubClient, hubPort
+
+    with hubLock:
+        try:
+            destination = findHubPort(name)
+            if not destination: return False
+
+            if sendWithoutWaiting([alsa_midi.EchoEvent()], destination): return True
+            logger.debug(f'Probe of {name} failed: port is full')
+        except Exception as e:
+            logger.debug(f'Probe of {name} failed: {e}')
+
+    return False
+
+#
+# The DynamoDB table name is an output of our CloudFormation stack. If we
+# can't find it (perhaps we're not running in AWS) then latency figures
+# are still kept in memory, they just aren't stored anywhere.
+#
+def getLatencyTable():
+    global logger
+
+    try:
+        with open('../cloudformationstackname') as cfnfile:
+            stackName = cfnfile.read().strip()
+
+        response = boto3.client('cloudformation').describe_stacks(StackName=stackName)
+    except Exception as e:
+        logger.warning(f'Cannot get stack information - latency will not be saved: {e}')
+        return False
+
+    for output in response['Stacks'][0]['Outputs']:
+        if output['OutputKey'] == 'DynamoDBTableName':
+            return boto3.resource('dynamodb').Table(output['OutputValue'])
+
+    logger.warning('Did not find DynamoDB table name - latency will not be saved')
+    return False
+
 #
 # Use the alsa midi interface to see all of the MIDI "ports" or "clients"
 # that are open on this server; and all of the participants in those ports.
 # We're not interested in the low numbered prots (below 128) - when the MIDI
 # daemon starts it is allocated a port number from 128 upwards.
 #
-# We want to connect an input port (the first port in the group) to an
-# output port (the second port in the group). This will prevent MIDI packet
-# loops (which are bad).
+# We connect the input port (the first port in a group) of each group to the
+# output port (the second port) of every group it is linked to - usually
+# just its own, or everyone else's when we are given a list of participants.
+# Input ports are never connected to each other which prevents MIDI packet
+# loops (which are bad). Only the connections that are missing are added and
+# only connections between our own ports that shouldn't be there are
+# removed so that nothing else is disturbed.
 #
 def checkMidiParticipants():
-    global logger
+    global logger, midiPorts, midiLinks
 
     groupPorts = {}
 
@@ -128,26 +1009,36 @@ def checkMidiParticipants():
     for client in otherClients:
         logger.debug(f' Client: {client.name}')
         if client.name.startswith('midiHub-'):
-            nameList = client.name.split('-')
-            groupPorts[f'{nameList[1]}-{nameList[2]}'] = client
+            groupPorts[client.name[len('midiHub-'):]] = client
+
+    hubClientIds = [client.client_id for client in groupPorts.values()]
 
     for group in midiPorts:
-        try:
-            inPortClient = groupPorts[f'{group}-{midiPorts[group][0]}']
-            outPortClient = groupPorts[f'{group}-{midiPorts[group][1]}']
-        except Exception as e:
-            logger.warning(f'  alsa client not found: {e}')
+        inPortClient = groupPorts.get(f'{group}-{midiPorts[group][0]}')
+        if not inPortClient:
+            logger.warning(f'  alsa client not found: {group}-{midiPorts[group][0]}')
             continue
 
-        inputSubs = alsaClient.list_port_subscribers(inPortClient)
-        alreadySubscribed = False
+        wantedClients = {}
+        for sender, receiver in midiLinks:
+            if sender != group: continue
+
+            outPortClient = groupPorts.get(f'{receiver}-{midiPorts[receiver][1]}')
+            if outPortClient:
+                wantedClients[outPortClient.client_id] = outPortClient
+            else:
+                logger.warning(f'  alsa client not found: {receiver}-{midiPorts[receiver][1]}')
+
+        inputSubs = alsaClient.list_port_subscribers(inPortClient, type=alsa_midi.SubscriptionQueryType.READ)
         for sub in inputSubs:
-            if sub.addr.client_id == outPortClient.client_id:
-                alreadySubscribed = True
+            if sub.addr.client_id in wantedClients:
+                outPortClient = wantedClients.pop(sub.addr.client_id)
                 logger.debug(f'  {inPortClient.name} already connected to {outPortClient.name}')
-                break
+            elif sub.addr.client_id in hubClientIds:
+                logger.info(f'  Removing connection for group {group} from client {inPortClient.name} to {sub.addr}')
+                alsaClient.unsubscribe_port(inPortClient, sub.addr)
 
-        if not alreadySubscribed:
+        for outPortClient in wantedClients.values():
             logger.info(f'  Adding connection for group {group} from client {inPortClient.name} to {outPortClient.name}')
             alsaClient.subscribe_port(inPortClient, outPortClient)
 
@@ -174,22 +1065,20 @@ def alreadyRunning():
 #
 # There's no point trying to run the MIDI daemon if there aren't a few
 # drivers running on the system (soundcore and snd-dummy); and we want
-# to make sure that the MIDI daemon itself is here somewhere too.
+# to make sure that the MIDI daemon itself is here somewhere too. Both
+# modules are checked at the same time.
 #
 def checkPrerequisites():
     global logger
 
-    logger.debug('Checking for soundcore module')
-    output = os.popen('/usr/sbin/modinfo soundcore 2>&1').read()
-    if output.find('not found') > -1:
-        logger.warning('Kernel module soundcore not found - stopping')
-        return False
-
-    logger.debug('Checking for snd-dummy module')
-    output = os.popen('/usr/sbin/modinfo snd-dummy 2>&1').read()
-    if output.find('not found') > -1:
-        logger.warning('Kernel module snd-dummy not found - stopping')
-        return False
+    logger.debug('Checking for soundcore and snd-dummy modules')
+    checks = {module:subprocess.Popen(['/usr/sbin/modinfo', module], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+              for module in ('soundcore', 'snd-dummy')}
+    for module in checks:
+        output = checks[module].communicate()[0]
+        if output.find('not found') > -1:
+            logger.warning(f'Kernel module {module} not found - stopping')
+            return False
 
     logger.debug('Checking for MIDI daemon code')
     if not os.path.isfile(MIDI_INPUT_DAEMON):
@@ -203,33 +1092,79 @@ def checkPrerequisites():
 
 #
 # A few things to do here.
-# First we look for our configuration file which (if it exists) contains a
-# comma-separated list of UDP ports that we are to listen to. If it's empty
-# or malformed then we go with the defaults set at the start of this file.
-# This is also called if we're sent SIGHUP mainly so that we can re-read the
-# ports configuration file.
+# First we look for our configuration file which (if it exists) lists the
+# groups of UDP ports that we are to listen to, or the participants that we
+# should build groups for (see midiconfig.py). If it's empty or malformed
+# then we go with what we had before - the defaults set at the start of this
+# file if this is the first time through.
+# This is also called after SIGHUP so that we can re-read the ports
+# configuration file.
 #
 def configure(singal, frame):
-    global logger, location, midiPorts
+    global logger, location, midiConfig, midiPorts, midiLinks
 
     try:
-        with open('midiports') as portsFile:
-            portsList = portsFile.read()
-
-        midiPorts = json.loads(portsList)
+        newConfig = midiconfig.readMidiPorts()
     except FileNotFoundError: # No ports file found - that's quite ok
         logger.info('No ports file found - using defaults')
+        newConfig = midiConfig
 
         #
         # But because our stuck note fixer-upper needs to know the same port
         # numbers we will write out the values we're given.
         #
         with open('midiports', 'w') as portsFile:
-            portsFile.write(json.dumps(midiPorts))
+            portsFile.write(json.dumps(midiConfig))
     except Exception as e:
         logger.warning(f'Got error {e} - ports file badly formatted?')
+        newConfig = midiConfig
+
+    try:
+        newPorts = midiconfig.getGroups(newConfig)
+        newLinks = midiconfig.getLinks(newConfig)
+        for group in newPorts:
+            midiconfig.getScheduling(newConfig, 'input', group)
+            midiconfig.getScheduling(newConfig, 'output', group)
+    except Exception as e:
+        logger.warning(f'Got error {e} - ports file not valid - keeping current configuration')
+        newConfig = midiConfig
+        newPorts = midiconfig.getGroups(midiConfig)
+        newLinks = midiconfig.getLinks(midiConfig)
+
+    midiConfig = newConfig
+    midiPorts = newPorts
+    midiLinks = newLinks
 
     logger.info(f'MIDI ports: {midiPorts}')
+    for line in connectionInstructions():
+        logger.info(line)
+
+#
+# Tells each participant (or group) which ports they should connect to.
+#
+def connectionInstructions():
+    global midiConfig, midiPorts, midiLinks
+
+    instructions = []
+    participants = midiconfig.getParticipantPorts(midiConfig)
+
+    for group in midiPorts:
+        inputPort, outputPort = midiPorts[group]
+        receivers = [receiver for sender, receiver in midiLinks if sender == group]
+
+        if group in participants:
+            senders = [sender for sender, receiver in midiLinks if receiver == group and sender != group]
+            instructions.append(f'{group}: connect your MIDI Out to port {inputPort} and your MIDI In to port {outputPort} - you will hear {", ".join(senders) or "nobody"}')
+        else:
+            listenPorts = ', '.join([str(midiPorts[receiver][1]) for receiver in receivers])
+            instructions.append(f'{group}: MIDI Out sent to port {inputPort} is heard by MIDI In connected to port {listenPorts}')
+
+    return instructions
+
+def hangup(signal, frame):
+    global reconfigureRequested
+
+    reconfigureRequested = True
 
 def interrupted(signal, frame):
     global logger
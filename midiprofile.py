@@ -0,0 +1,113 @@
+#
+# midiprofile.py
+#  Profiling on demand for the scripts that run for a whole session
+#  (midihub.py, fix-stuck-notes.py and alsaserver.py) so that a hub that
+#  is misbehaving can be looked at without restarting anything:
+#   kill -USR1 <pid>  - start profiling; send it again to stop and write
+#                       out the results
+#   kill -USR2 <pid>  - write out the results so far and keep going
+#  Results are written to ../profile-{name}.txt (next to the logs): the
+#  cProfile statistics sorted by cumulative time, then a summary of each
+#  hot path timed with start() and record() - how many times it ran, the
+#  average, the 99th percentile and the worst. While profiling is off the
+#  hot paths only check a flag.
+#  cProfile only sees the main thread.
+#
+
+import os
+import time
+import signal
+import cProfile
+import pstats
+import io
+
+maxSamples = 100000 # Per hot path - after that only the totals are kept
+
+active = False
+profileName = None
+logger = None
+profiler = None
+startTime = 0
+timings = {}
+
+def install(name, log):
+    global profileName, logger
+
+    profileName = name
+    logger = log
+
+    signal.signal(signal.SIGUSR1, toggle)
+    signal.signal(signal.SIGUSR2, snapshot)
+
+#
+# Hot paths do:
+#  started = midiprofile.start()
+#  ...
+#  if started: midiprofile.record('name', started)
+#
+def start():
+    return time.perf_counter() if active else 0
+
+def record(name, started):
+    elapsed = time.perf_counter()-started
+
+    timing = timings.get(name)
+    if not timing:
+        timing = timings[name] = {'count':0, 'total':0.0, 'worst':0.0, 'samples':[]}
+
+    timing['count'] += 1
+    timing['total'] += elapsed
+    if elapsed > timing['worst']: timing['worst'] = elapsed
+    if len(timing['samples']) < maxSamples: timing['samples'].append(elapsed)
+
+def toggle(signalNumber, frame):
+    global active, profiler, startTime, timings
+
+    if not active:
+        logger.info(f'Profiling started - send SIGUSR1 to pid {os.getpid()} again to stop')
+        timings = {}
+        startTime = time.time()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        active = True
+        return
+
+    active = False
+    profiler.disable()
+    writeResults()
+    profiler = None
+
+def snapshot(signalNumber, frame):
+    if not active:
+        logger.info('Profiling is not running - send SIGUSR1 to start it')
+        return
+
+    profiler.disable()
+    writeResults()
+    profiler.enable()
+
+def writeResults():
+    fileName = f'../profile-{profileName}.txt'
+
+    statistics = io.StringIO()
+    pstats.Stats(profiler, stream=statistics).sort_stats('cumulative').print_stats(40)
+
+    try:
+        with open(fileName, 'w') as profileFile:
+            profileFile.write(f'{profileName} (pid {os.getpid()}) profiled for {time.time()-startTime:.1f}s'
+                              f' from {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(startTime))}\n\n')
+
+            profileFile.write(f'{"hot path":30} {"count":>10} {"average":>10} {"99%":>10} {"worst":>10} (milliseconds)\n')
+            for name in sorted(timings):
+                timing = timings[name]
+                samples = sorted(timing['samples'])
+                percentile = samples[min(len(samples)-1, int(len(samples)*0.99))]
+                profileFile.write(f'{name:30} {timing["count"]:10} {timing["total"]/timing["count"]*1000:10.3f}'
+                                  f' {percentile*1000:10.3f} {timing["worst"]*1000:10.3f}\n')
+
+            profileFile.write('\n'+statistics.getvalue())
+    except Exception as e:
+        logger.error(f'Cannot write profile to {fileName}: {e}')
+        return
+
+    logger.info(f'Profile written to {fileName}')
@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+
+#
+# probe-endpoints.py
+#  For participants to run on their own computer to find out which of the
+#  hub's addresses - the Elastic IP or one of the Global Accelerator IPs -
+#  is quickest from where they are. For example:
+#   ./probe-endpoints.py 5040 203.0.113.10 198.51.100.1 198.51.100.2
+#  Each address is joined as an RTP MIDI session on the port given (use your
+#  MIDI Out port) and the same clock sync exchange that your MIDI software
+#  uses is repeated a number of times. All of the addresses are tested at
+#  the same time so that they see the same network conditions. The results
+#  are listed fastest first. Needs nothing but Python 3.
+#
+#  Optional settings go after the addresses:
+#   count=50     - how many clock syncs to send to each address
+#   interval=100 - milliseconds between them
+#
+
+import sys
+import socket
+import struct
+import random
+import time
+import statistics
+import concurrent.futures
+
+sessionName = b'midihub-probe'
+replyTimeout = 1
+
+def exchangePacket(command, token, ssrc):
+    return b'\xff\xff'+command+struct.pack('>III', 2, token, ssrc)+sessionName+b'\x00'
+
+def timestampPacket(ssrc, count, timestamps):
+    return b'\xff\xffCK'+struct.pack('>IB3xQQQ', ssrc, count, *timestamps)
+
+#
+# Joins the session on the control port and the data port (one above) the
+# same way MIDI software does. Returns the two sockets or raises an
+# exception saying why not. Replies are taken from whatever address they
+# come from as they don't always come back from the one we sent to.
+#
+def joinSession(host, port, ssrc):
+    token = random.randint(0, 2**32-1)
+    sockets = []
+
+    try:
+        for sessionPort in (port, port+1):
+            sessionSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sessionSocket.settimeout(replyTimeout)
+            sockets.append(sessionSocket)
+            sessionSocket.sendto(exchangePacket(b'IN', token, ssrc), (host, sessionPort))
+
+            reply = sessionSocket.recv(1024)
+            if reply[2:4] != b'OK':
+                raise Exception(f'invitation on port {sessionPort} refused ({reply[2:4]})')
+    except Exception:
+        for sessionSocket in sockets: sessionSocket.close()
+        raise
+
+    return sockets
+
+def leaveSession(sockets, host, port, ssrc):
+    try:
+        sockets[0].sendto(exchangePacket(b'BY', 0, ssrc), (host, port))
+    except OSError:
+        pass
+
+    for sessionSocket in sockets: sessionSocket.close()
+
+#
+# Sends count clock syncs (CK) to the data port and returns the round trip
+# time of each in milliseconds, or None for any that got no reply. Our own
+# timestamp (in microseconds) comes back in the reply so late replies can't
+# be mistaken for the one we're waiting for.
+#
+def measure(dataSocket, address, ssrc, count, interval):
+    results = []
+
+    for _ in range(count):
+        sent = time.perf_counter_ns()//1000
+        dataSocket.sendto(timestampPacket(ssrc, 0, (sent, 0, 0)), address)
+
+        rtt = None
+        deadline = time.monotonic()+replyTimeout
+        while rtt is None and time.monotonic() < deadline:
+            dataSocket.settimeout(max(0.001, deadline-time.monotonic()))
+            try:
+                reply = dataSocket.recv(1024)
+            except socket.timeout:
+                break
+
+            if len(reply) < 36 or reply[2:4] != b'CK': continue
+            replyCount, timestamp1, timestamp2 = struct.unpack('>B3xQQ', reply[8:28])
+            if replyCount != 1 or timestamp1 != sent: continue
+
+            received = time.perf_counter_ns()//1000
+            rtt = (received-sent)/1000
+            dataSocket.sendto(timestampPacket(ssrc, 2, (sent, timestamp2, received)), address)
+
+        results.append(rtt)
+        time.sleep(max(0, sent/1000000+interval-time.perf_counter()))
+
+    return results
+
+#
+# Runs in its own thread for each address. Returns a summary dictionary.
+#
+def probe(host, port, count, interval):
+    ssrc = random.randint(0, 2**32-1)
+    summary = {'host':host, 'error':None}
+
+    try:
+        sockets = joinSession(host, port, ssrc)
+    except Exception as e:
+        summary['error'] = f'cannot join session: {e}'
+        return summary
+
+    try:
+        results = measure(sockets[1], (host, port+1), ssrc, count, interval)
+    finally:
+        leaveSession(sockets, host, port, ssrc)
+
+    rtts = [rtt for rtt in results if rtt is not None]
+    summary['lost'] = len(results)-len(rtts)
+    if not rtts:
+        summary['error'] = 'no replies to clock sync'
+        return summary
+
+    rtts.sort()
+    summary['median'] = statistics.median(rtts)
+    summary['mean'] = statistics.mean(rtts)
+    summary['minimum'] = rtts[0]
+    summary['p95'] = rtts[min(len(rtts)-1, int(len(rtts)*0.95))]
+    # Jitter as RTP does it - the average change from one packet to the next
+    summary['jitter'] = statistics.mean([abs(a-b) for a, b in zip(results, results[1:]) if a is not None and b is not None] or [0])
+
+    return summary
+
+#
+# Fastest first: by median round trip plus jitter (a late note is as bad
+# as a slow one), with anything that lost packets after anything that
+# didn't, and anything that didn't answer at all last.
+#
+def rankKey(summary):
+    if summary['error']: return (2, 0)
+    return (1 if summary['lost'] else 0, summary['median']+summary['jitter'])
+
+def main():
+    arguments = [argument for argument in sys.argv[1:] if '=' not in argument]
+    settings = dict(argument.split('=', 1) for argument in sys.argv[1:] if '=' in argument)
+
+    if len(arguments) < 2:
+        print(f'usage: {sys.argv[0]} port address [address ...] [count=50] [interval=100]')
+        sys.exit(1)
+
+    port = int(arguments[0])
+    hosts = arguments[1:]
+    count = int(settings.get('count', 50))
+    interval = float(settings.get('interval', 100))/1000
+
+    print(f'Probing {len(hosts)} addresses on port {port} with {count} clock syncs each - about {max(1, round(count*interval))} seconds')
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        summaries = list(executor.map(lambda host: probe(host, port, count, interval), hosts))
+
+    summaries.sort(key=rankKey)
+
+    print(f'\n{"":4}{"address":40} {"median":>8} {"mean":>8} {"min":>8} {"p95":>8} {"jitter":>8} {"lost":>5}')
+    for rank, summary in enumerate(summaries, 1):
+        if summary['error']:
+            print(f'{rank:<4}{summary["host"]:40} {summary["error"]}')
+            continue
+        print(f'{rank:<4}{summary["host"]:40} {summary["median"]:8.2f} {summary["mean"]:8.2f} {summary["minimum"]:8.2f} '
+              f'{summary["p95"]:8.2f} {summary["jitter"]:8.2f} {summary["lost"]:5}')
+    print('(times in milliseconds)\n')
+
+    best = summaries[0]
+    if best['error']:
+        print('None of the addresses answered - check the port number and that the hub is running')
+        sys.exit(1)
+
+    if len(summaries) > 1 and not summaries[1]['error'] and rankKey(summaries[1])[0] == rankKey(best)[0] \
+            and rankKey(summaries[1])[1]-rankKey(best)[1] < 1:
+        print(f'Use {best["host"]} - although {summaries[1]["host"]} is within a millisecond so either will do')
+    else:
+        print(f'Use {best["host"]}')
+
+if __name__ == '__main__':
+    main()
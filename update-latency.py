@@ -11,6 +11,10 @@
 #  table in it.
 #  Output to DynamoDB is the maximum, minimum and last latency for each client
 #  as well as the current timestamp.
+#  Because the whole of each log file is read every time, what was written is
+#  remembered in a local file called "latencycheckpoint" and only clients
+#  with new samples since then are written - and only the attributes that
+#  have changed. Nothing at all is written while nobody is playing.
 #
 
 import sys
@@ -19,9 +23,11 @@ import boto3
 import datetime
 import sys
 import re
+import json
 
 logger = None
 dynamodb = boto3.resource('dynamodb')
+checkpointFile = 'latencycheckpoint'
 cfn = boto3.client('cloudformation')
 
 def main():
@@ -94,22 +100,65 @@ def main():
         if latencyValue < minLatency[id][1]: minLatency[id] = (epochTime, latencyValue)
         lastLatency[id] = epochTime
 
+    try:
+        with open(checkpointFile) as checkpoint:
+            lastWritten = json.loads(checkpoint.read())
+    except FileNotFoundError:
+        lastWritten = {}
+    except Exception as e:
+        logger.warning(f'Cannot read checkpoint - writing everything: {e}')
+        lastWritten = {}
+
+    now = int(datetime.datetime.now().timestamp())
+    expiry = now+(86400*7) # Expire this record in seven days
+
     ddbTable = dynamodb.Table(tableName)
-    with ddbTable.batch_writer() as batch:
-        for id in latencyStats:
-            average = round(sum(latencyStats[id])/len(latencyStats[id]), 1)
-
-            now = int(datetime.datetime.now().timestamp())
-            expiry = now+(86400*7) # Expire this record in seven days
-
-            # Need to store floats as strings because DynamoDB doesn't support
-            # float typess here
-            item = {'clientId':id, 'timestamp':now, 'expiryTime':expiry,
-                    'lastLatency':str(latencyStats[id][-1]), 'lastLatencyTime':lastLatency[id],
-                    'maxLatency':str(maxLatency[id][1]), 'maxLatencyTime':maxLatency[id][0],
-                    'minLatency':str(minLatency[id][1]), 'minLatencyTime':minLatency[id][0],
-                    'averageLatency':str(average)}
-            batch.put_item(Item=item)
+    for id in latencyStats:
+        previous = lastWritten.get(id, {})
+        current = {'count':len(latencyStats[id]), 'lastLatencyTime':lastLatency[id],
+                   'max':list(maxLatency[id]), 'min':list(minLatency[id])}
+        if previous.get('count') == current['count'] and previous.get('lastLatencyTime') == current['lastLatencyTime']:
+            continue # No new samples for this client
+
+        average = round(sum(latencyStats[id])/len(latencyStats[id]), 1)
+
+        # Need to store floats as strings because DynamoDB doesn't support
+        # float typess here
+        updates = {'timestamp':now, 'expiryTime':expiry,
+                   'lastLatency':str(latencyStats[id][-1]), 'lastLatencyTime':lastLatency[id],
+                   'averageLatency':str(average)}
+        if previous.get('max') != current['max']:
+            updates['maxLatency'] = str(maxLatency[id][1])
+            updates['maxLatencyTime'] = maxLatency[id][0]
+        if previous.get('min') != current['min']:
+            updates['minLatency'] = str(minLatency[id][1])
+            updates['minLatencyTime'] = minLatency[id][0]
+
+        names = {f'#{name}':name for name in updates}
+        values = {f':{name}':updates[name] for name in updates}
+
+        #
+        # Don't overwrite figures that are newer than ours (midihub.py may
+        # be writing them as well).
+        #
+        try:
+            ddbTable.update_item(Key={'clientId':id},
+                                 UpdateExpression='SET '+', '.join([f'#{name} = :{name}' for name in updates]),
+                                 ConditionExpression='attribute_not_exists(#lastLatencyTime) OR #lastLatencyTime <= :lastLatencyTime',
+                                 ExpressionAttributeNames=names, ExpressionAttributeValues=values)
+        except ddbTable.meta.client.exceptions.ConditionalCheckFailedException:
+            logger.info(f'Newer latency already saved for {id} - skipping')
+        except Exception as e:
+            logger.error(f'Failed to save latency for {id}: {e}')
+            continue
+
+        lastWritten[id] = current
+
+    try:
+        with open(checkpointFile, 'w') as checkpoint:
+            checkpoint.write(json.dumps(lastWritten))
+    except Exception as e:
+        logger.error(f'Cannot write checkpoint: {e}')
 
 if __name__ == "__main__":
     main()